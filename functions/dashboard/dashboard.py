@@ -4,6 +4,11 @@ import os
 from datetime import datetime, timedelta
 from botocore.exceptions import ClientError
 from ec2Client import terminate_aws_ec2_instance
+from sessionToken import verify_token, get_token_from_event, redact_event, TokenError
+from bmdata import User, Subscription, EngineInstance, Event
+from engineHosts import release_session
+from activeEngine import backfill_active_instance_id
+from engineMetrics import get_engine_metrics, get_fleet_metrics
 
 dynamodb = boto3.client('dynamodb')
 
@@ -41,90 +46,123 @@ def get_user_info(user_id, user_table):
     try:
         response = dynamodb.get_item(
             TableName=user_table,
-            Key={'userId': {'S': user_id}}
+            Key={'userId': {'S': user_id}},
+            **User.projection('name', 'phone', 'created_time', 'is_active', 'active_instance_id', 'engine_pointer_checked')
         )
         
         user_item = response.get('Item')
         if not user_item:
             raise ValueError('User not found')
         
-        if not user_item.get('isActive', {}).get('BOOL', False):
+        user = User.from_item(user_item)
+        if not user.is_active:
             raise ValueError('User account is inactive')
         
+        if not user.active_instance_id and not user.engine_pointer_checked:
+            # Engines from before the pointer existed are found once and pointed to
+            user.active_instance_id = backfill_active_instance_id(
+                user_id, user_table, os.environ.get('ENGINE_INSTANCE_TABLE')
+            )
+        
         return {
-            'name': user_item.get('name', {}).get('S', 'Unknown User'),
+            'name': user.name or 'Unknown User',
             'email': user_id,
-            'phone': user_item.get('phone', {}).get('S', ''),
-            'createdTime': int(user_item.get('createdTime', {}).get('N', 0)),
-            'isActive': user_item.get('isActive', {}).get('BOOL', False)
+            'phone': user.phone,
+            'createdTime': user.created_time,
+            'isActive': user.is_active,
+            'activeInstanceId': user.active_instance_id
         }
     except ClientError as e:
         print(f"Error getting user info: {e}")
         raise ValueError('Failed to retrieve user information')
 
+# What the dashboard shows for a missing subscription row or attribute
+DEFAULT_SUBSCRIPTION = {
+    'messageCountUsed': 0,
+    'messageCountLeft': 100,
+    'engineHourUsed': 0,
+    'engineHourLeft': 10
+}
+
 def get_user_subscription(user_id, subscription_table):
     """Get user subscription information"""
     try:
         response = dynamodb.get_item(
             TableName=subscription_table,
-            Key={'userId': {'S': user_id}}
+            Key={'userId': {'S': user_id}},
+            **Subscription.projection('message_count_used', 'message_count_left', 'engine_hour_used', 'engine_hour_left')
         )
         
         subscription_item = response.get('Item')
         if not subscription_item:
             # Return default subscription if not found
-            return {
-                'messageCountUsed': 0,
-                'messageCountLeft': 100,
-                'engineHourUsed': 0,
-                'engineHourLeft': 10
-            }
+            return dict(DEFAULT_SUBSCRIPTION)
         
+        subscription = Subscription.from_item(subscription_item).to_dict()
+        # Attributes missing from the row keep the dashboard's defaults
         return {
-            'messageCountUsed': int(subscription_item.get('messageCountUsed', {}).get('N', 0)),
-            'messageCountLeft': int(subscription_item.get('messageCountLeft', {}).get('N', 100)),
-            'engineHourUsed': int(subscription_item.get('engineHourUsed', {}).get('N', 0)),
-            'engineHourLeft': int(subscription_item.get('engineHourLeft', {}).get('N', 10))
+            name: subscription[name] if name in subscription_item else default
+            for name, default in DEFAULT_SUBSCRIPTION.items()
         }
     except ClientError as e:
         print(f"Error getting subscription info: {e}")
         raise ValueError('Failed to retrieve subscription information')
 
-def get_active_instance(user_id, engine_table):
-    """Get user's active WhatsApp instance"""
+def get_active_instance(user_id, active_instance_id, engine_table):
+    """Get user's active WhatsApp instance via the active-engine pointer"""
+    if not active_instance_id:
+        return None
+
     try:
-        response = dynamodb.query(
+        response = dynamodb.get_item(
             TableName=engine_table,
-            KeyConditionExpression='userId = :userId',
-            FilterExpression='isActive = :isActive',
-            ExpressionAttributeValues={
-                ':userId': {'S': user_id},
-                ':isActive': {'BOOL': True}
-            }
+            Key={
+                'userId': {'S': user_id},
+                'instanceId': {'S': active_instance_id}
+            },
+            **EngineInstance.projection('instance_id', 'created_time', 'whatsapp_link_time', 'is_active', 'host_id', 'host_port')
         )
-        
-        instances = response.get('Items', [])
-        if not instances:
+
+        active_instance = response.get('Item')
+        if not active_instance:
             return None
-        
-        # Return the most recent active instance
-        active_instance = instances[0]
+
+        instance = EngineInstance.from_item(active_instance)
+        if not instance.is_active:
+            return None
+
         return {
-            'instanceId': active_instance.get('instanceId', {}).get('S', ''),
-            'createdTime': int(active_instance.get('createdTime', {}).get('N', 0)),
-            'whatsappLinkTime': int(active_instance.get('whatsappLinkTime', {}).get('N', 0)) if active_instance.get('whatsappLinkTime') else None,
-            'isActive': active_instance.get('isActive', {}).get('BOOL', False)
+            'instanceId': instance.instance_id,
+            'createdTime': instance.created_time,
+            'whatsappLinkTime': instance.whatsapp_link_time,
+            'isActive': instance.is_active,
+            'hostId': instance.host_id,
+            'hostPort': instance.host_port,
+            'load': get_engine_load(instance.instance_id)
         }
     except ClientError as e:
         print(f"Error getting active instance: {e}")
         return None
 
+def get_engine_load(instance_id):
+    """Last five minutes of collector samples; the dashboard works without them"""
+    try:
+        return get_engine_metrics(instance_id, minutes=5)
+    except Exception as e:
+        print(f"Error getting engine load: {e}")
+        return None
+
 def get_recent_events(user_id, event_table, limit=10):
     """Get user's recent broadcast events"""
     try:
         # Get events from the last 30 days
         thirty_days_ago = int((datetime.now() - timedelta(days=30)).timestamp())
         
+        query_params = Event.projection(
+            'event_id', 'title', 'description', 'message_text', 'recipient_count',
+            'success_count', 'failure_count', 'delivered_count', 'read_count', 'status',
+            'created_time', 'completed_time'
+        )
         response = dynamodb.query(
             TableName=event_table,
             KeyConditionExpression='userId = :userId',
@@ -134,22 +172,26 @@ def get_recent_events(user_id, event_table, limit=10):
                 ':thirtyDaysAgo': {'N': str(thirty_days_ago)}
             },
             ScanIndexForward=False,  # Sort by sort key in descending order
-            Limit=limit
+            Limit=limit,
+            **query_params
         )
         
         events = []
         for item in response.get('Items', []):
+            event = Event.from_item(item)
             events.append({
-                'eventId': item.get('eventId', {}).get('S', ''),
-                'title': item.get('title', {}).get('S', 'Untitled Event'),
-                'description': item.get('description', {}).get('S', ''),
-                'messageText': item.get('messageText', {}).get('S', ''),
-                'recipientCount': int(item.get('recipientCount', {}).get('N', 0)),
-                'successCount': int(item.get('successCount', {}).get('N', 0)),
-                'failureCount': int(item.get('failureCount', {}).get('N', 0)),
-                'status': item.get('status', {}).get('S', 'unknown'),
-                'createdTime': int(item.get('createdTime', {}).get('N', 0)),
-                'completedTime': int(item.get('completedTime', {}).get('N', 0)) if item.get('completedTime') else None
+                'eventId': event.event_id,
+                'title': event.title or 'Untitled Event',
+                'description': event.description,
+                'messageText': event.message_text,
+                'recipientCount': event.recipient_count,
+                'successCount': event.success_count,
+                'failureCount': event.failure_count,
+                'deliveredCount': event.delivered_count,
+                'readCount': event.read_count,
+                'status': event.status,
+                'createdTime': event.created_time,
+                'completedTime': event.completed_time
             })
         
         return events
@@ -183,7 +225,7 @@ def calculate_usage_stats(subscription_info, recent_events):
         'successRate': round(success_rate, 1)
     }
 
-def get_whatsapp_status(active_instance,user_id, engine_table):
+def get_whatsapp_status(active_instance, user_id, user_table, engine_table):
     """Determine WhatsApp connection status"""
     status ={
         'status': 'disconnected',
@@ -195,36 +237,72 @@ def get_whatsapp_status(active_instance,user_id, engine_table):
         return status
     
     instance_id = active_instance.get('instanceId')
-    terminate_aws_ec2_instance(instance_id)
-    # Mark instance as inactive in database
-    update_params = {
-            'TableName': engine_table,
-            'Key': {
-                'userId': {'S': user_id},
-                'instanceId': {'S': instance_id}
-            },
-            'UpdateExpression': 'SET isActive = :isActive, terminatedTime = :terminatedTime',
-            'ExpressionAttributeValues': {
-                ':isActive': {'BOOL': False},
-                ':terminatedTime': {'N': str(int(datetime.now().timestamp()))}
+    if active_instance.get('hostId'):
+        release_session(active_instance['hostId'], active_instance['hostPort'])
+    else:
+        terminate_aws_ec2_instance(instance_id)
+    # Mark instance as inactive and clear the user's active-engine pointer together
+    now_time = str(int(datetime.now().timestamp()))
+    dynamodb.transact_write_items(TransactItems=[
+        {
+            'Update': {
+                'TableName': engine_table,
+                'Key': {
+                    'userId': {'S': user_id},
+                    'instanceId': {'S': instance_id}
+                },
+                'UpdateExpression': 'SET isActive = :isActive, terminatedTime = :terminatedTime',
+                'ExpressionAttributeValues': {
+                    ':isActive': {'BOOL': False},
+                    ':terminatedTime': {'N': now_time}
+                }
+            }
+        },
+        {
+            'Update': {
+                'TableName': user_table,
+                'Key': {'userId': {'S': user_id}},
+                'UpdateExpression': (
+                    'REMOVE activeInstanceId, engineLeaseId, engineLeaseExpiresAt, engineLeaseInstanceId '
+                    'SET modifiedTime = :modifiedTime'
+                ),
+                'ConditionExpression': 'activeInstanceId = :instanceId',
+                'ExpressionAttributeValues': {
+                    ':instanceId': {'S': instance_id},
+                    ':modifiedTime': {'N': now_time}
+                }
             }
         }
-    dynamodb.update_item(**update_params)
+    ])
     return status
 
 def lambda_handler(event, context):
     """Main Lambda handler for dashboard summary"""
     try:
-        print("Dashboard summary request:", json.dumps(event, indent=2))
+        print("Dashboard summary request:", json.dumps(redact_event(event), indent=2))
         
         # Validate environment variables
         tables = validate_environment_variables()
         
         # Extract user ID from event (assuming it comes from authenticated context)
         user_id = None
+        body = {}
+        if isinstance(event.get('body'), str):
+            try:
+                body = json.loads(event['body'])
+            except json.JSONDecodeError:
+                pass
         
         # Try to get user ID from different sources
-        if 'requestContext' in event and 'authorizer' in event['requestContext']:
+        token = get_token_from_event(event, body)
+        if token:
+            # Signed session from login, verified locally
+            try:
+                user_id = verify_token(token)['sub']
+            except TokenError as te:
+                print(f"Session token rejected: {te}")
+                return format_json_response({'message': str(te)}, 401)
+        elif 'requestContext' in event and 'authorizer' in event['requestContext']:
             # From API Gateway authorizer
             user_id = event['requestContext']['authorizer'].get('userId')
         elif 'pathParameters' in event and event['pathParameters']:
@@ -235,14 +313,8 @@ def lambda_handler(event, context):
             user_id = event['queryStringParameters'].get('userId')
         
         # For development/testing, allow user ID from body
-        if not user_id and 'body' in event:
-            body = event['body']
-            if isinstance(body, str):
-                try:
-                    body = json.loads(body)
-                    user_id = body.get('userId')
-                except json.JSONDecodeError:
-                    pass
+        if not user_id:
+            user_id = body.get('userId')
         
         if not user_id:
             return format_json_response({'message': 'User ID is required'}, 401)
@@ -254,7 +326,7 @@ def lambda_handler(event, context):
         subscription_info = get_user_subscription(user_id, tables['USER_SUBSCRIPTION_TABLE'])
         
         # Get active WhatsApp instance
-        active_instance = get_active_instance(user_id, tables['ENGINE_INSTANCE_TABLE'])
+        active_instance = get_active_instance(user_id, user_info['activeInstanceId'], tables['ENGINE_INSTANCE_TABLE'])
         
         # Get recent events/campaigns
         recent_events = get_recent_events(user_id, tables['EVENT_TABLE'])
@@ -263,7 +335,7 @@ def lambda_handler(event, context):
         usage_stats = calculate_usage_stats(subscription_info, recent_events)
         
         # Get WhatsApp status
-        whatsapp_status = get_whatsapp_status(active_instance,user_id, tables['ENGINE_INSTANCE_TABLE'])
+        whatsapp_status = get_whatsapp_status(active_instance, user_id, tables['USER_TABLE'], tables['ENGINE_INSTANCE_TABLE'])
         
         # Prepare dashboard summary response
         dashboard_summary = {
@@ -279,7 +351,10 @@ def lambda_handler(event, context):
                 'hoursLeft': subscription_info['engineHourLeft']
             },
             'usage': usage_stats,
-            'whatsapp': whatsapp_status,
+            'whatsapp': {
+                **whatsapp_status,
+                'load': active_instance['load'] if active_instance else None
+            },
             'recentActivity': recent_events[:5],  # Return only 5 most recent
             'summary': {
                 'totalCampaigns': len(recent_events),
@@ -298,4 +373,22 @@ def lambda_handler(event, context):
         return format_json_response({'message': str(ve)}, 400)
     except Exception as e:
         print(f"Unexpected error: {e}")
-        return format_json_response({'message': 'Internal server error'}, 500)
\ No newline at end of file
+        return format_json_response({'message': 'Internal server error'}, 500)
+
+def fleet_handler(event, context):
+    """Operator-only fleet aggregates of the last 15 minutes.
+
+    Served from its own IAM-authenticated function URL: the numbers cover
+    every customer's engines, so they never go out with a user's dashboard.
+    """
+    try:
+        return format_json_response({
+            'success': True,
+            'data': {'fleet': get_fleet_metrics(minutes=15)}
+        })
+    except ValueError as ve:
+        print(f"Validation error: {ve}")
+        return format_json_response({'message': str(ve)}, 400)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return format_json_response({'message': 'Internal server error'}, 500)
@@ -4,6 +4,8 @@ import hmac
 import json
 import os
 from datetime import datetime
+from bmdata import User, Subscription
+from sessionToken import issue_token, verify_token, revoke_token, get_token_from_event, TokenError
 
 dynamodb = boto3.client('dynamodb')
 
@@ -20,6 +22,23 @@ def get_db_params(table_name: str, user_id: str):
         }
     }
 
+def batch_get_user_items(table_names, user_id: str, max_attempts: int = 3):
+    """Read the userId-keyed row from several tables in a single BatchGetItem"""
+    request_items = {
+        table_name: {'Keys': [{'userId': {'S': user_id}}]}
+        for table_name in table_names
+    }
+    items = {}
+    for _ in range(max_attempts):
+        response = dynamodb.batch_get_item(RequestItems=request_items)
+        for table_name, table_items in response.get('Responses', {}).items():
+            if table_items:
+                items[table_name] = table_items[0]
+        request_items = response.get('UnprocessedKeys')
+        if not request_items:
+            return items
+    raise RuntimeError('Unable to read user records, please retry')
+
 def format_json_response(message, status_code=200):
     return {
         'statusCode': status_code,
@@ -59,48 +78,46 @@ def lambda_handler(event, context):
                 return format_json_response({'message': 'userId, password, name, and phone are required'}, 400)
 
             try:
-                db_params_user = get_db_params(USER_TABLE, user_id)
-                user_info = dynamodb.get_item(**db_params_user).get('Item')
-
-                if user_info:
-                    return format_json_response({'message': 'User already exists'}, 409)
-
                 hashed_password = hash_password(password)
                 now_date = int(datetime.now().timestamp())
 
-                dynamodb.put_item(
-                    TableName=USER_TABLE,
-                    Item={
-                        'userId': {'S': user_id},
-                        'name': {'S': name},
-                        'password': {'S': hashed_password},
-                        'phone': {'S': phone},
-                        'isActive': {'BOOL': True},
-                        'createdTime': {'N': str(now_date)},
-                        'modifiedTime': {'N': str(now_date)},
-                    }
-                )
-
-                dynamodb.put_item(
-                    TableName=USER_SUBSCRIPTION,
-                    Item={
-                        'userId': {'S': user_id},
-                        'messageCountUsed': {'N': '0'},
-                        'messageCountLeft': {'N': '0'},
-                        'engineHourUsed': {'N': '0'},
-                        'engineHourLeft': {'N': '0'},
-                        'modifiedTime': {'N': str(now_date)},
-                    }
-                )
-
-                dynamodb.put_item(
-                    TableName=USER_LOGIN,
-                    Item={
-                        'userId': {'S': user_id},
-                        'loginInTime': {'S': str(now_date)},
-                        'modifiedTime': {'N': str(now_date)},
+                # One round-trip: the user, subscription and first login rows are
+                # created together or not at all, and the conditions make
+                # concurrent signups for the same userId lose cleanly.
+                dynamodb.transact_write_items(TransactItems=[
+                    {
+                        'Put': {
+                            'TableName': USER_TABLE,
+                            'Item': User(
+                                user_id=user_id,
+                                name=name,
+                                password=hashed_password,
+                                phone=phone,
+                                is_active=True,
+                                created_time=now_date,
+                                modified_time=now_date
+                            ).to_item(),
+                            'ConditionExpression': 'attribute_not_exists(userId)'
+                        }
+                    },
+                    {
+                        'Put': {
+                            'TableName': USER_SUBSCRIPTION,
+                            'Item': Subscription(user_id=user_id, modified_time=now_date).to_item(),
+                            'ConditionExpression': 'attribute_not_exists(userId)'
+                        }
+                    },
+                    {
+                        'Put': {
+                            'TableName': USER_LOGIN,
+                            'Item': {
+                                'userId': {'S': user_id},
+                                'loginInTime': {'S': str(now_date)},
+                                'modifiedTime': {'N': str(now_date)},
+                            }
+                        }
                     }
-                )
+                ])
 
                 return format_json_response({
                     'message': 'User account created successfully',
@@ -111,6 +128,13 @@ def lambda_handler(event, context):
                     'engineHourLeft': 0
                 })
 
+            except dynamodb.exceptions.TransactionCanceledException as err:
+                reasons = err.response.get('CancellationReasons', [])
+                if any(reason.get('Code') == 'ConditionalCheckFailed' for reason in reasons):
+                    return format_json_response({'message': 'User already exists'}, 409)
+                print(f"Signup error: {err}")
+                return format_json_response({'message': 'Error during signup', 'details': str(err)}, 500)
+
             except Exception as err:
                 print(f"Signup error: {err}")
                 return format_json_response({'message': 'Error during signup', 'details': str(err)}, 500)
@@ -121,18 +145,16 @@ def lambda_handler(event, context):
 
             try:
                 hashed_password = hash_password(password)
-                db_params = get_db_params(USER_TABLE, user_id)
-                user_info = dynamodb.get_item(**db_params).get('Item')
+                items = batch_get_user_items([USER_TABLE, USER_SUBSCRIPTION], user_id)
+                user_info = User.from_item(items.get(USER_TABLE, {}))
 
-                if not user_info or not user_info.get('isActive', {}).get('BOOL'):
+                if not user_info.is_active:
                     return format_json_response({'message': 'UserId or Password might be incorrect'}, 403)
 
-                if user_info['password']['S'] == hashed_password:
-                    db_params = get_db_params(USER_SUBSCRIPTION, user_id)
-                    user_subscription_info = dynamodb.get_item(**db_params).get('Item')
-
-                    if not user_subscription_info:
+                if hmac.compare_digest(user_info.password, hashed_password):
+                    if USER_SUBSCRIPTION not in items:
                         return format_json_response({'message': 'User subscription not found'}, 404)
+                    subscription = Subscription.from_item(items[USER_SUBSCRIPTION])
 
                     now_date = int(datetime.now().timestamp())
                     dynamodb.put_item(
@@ -145,13 +167,19 @@ def lambda_handler(event, context):
                     )
 
                     responses = {
-                        'name': user_info['name']['S'],
-                        'messageCountUsed': int(user_subscription_info['messageCountUsed']['N']),
-                        'messageCountLeft': int(user_subscription_info['messageCountLeft']['N']),
-                        'engineHourUsed': int(user_subscription_info['engineHourUsed']['N']),
-                        'engineHourLeft': int(user_subscription_info['engineHourLeft']['N']),
+                        'name': user_info.name,
+                        'messageCountUsed': subscription.message_count_used,
+                        'messageCountLeft': subscription.message_count_left,
+                        'engineHourUsed': subscription.engine_hour_used,
+                        'engineHourLeft': subscription.engine_hour_left,
                         'message': 'Successfully logged in'
                     }
+                    # Signed session token so message/dashboard can authenticate
+                    # the caller without reading the user tables on every request
+                    responses['token'] = issue_token(user_id, True, {
+                        'messageCountLeft': responses['messageCountLeft'],
+                        'engineHourLeft': responses['engineHourLeft']
+                    })
                     return format_json_response(responses)
 
                 else:
@@ -164,6 +192,15 @@ def lambda_handler(event, context):
         elif action.upper() == 'LOGOUT':
             if not user_id:
                 return format_json_response({'message': 'userId is required'}, 400)
+
+            token = get_token_from_event(event, body)
+            if token:
+                try:
+                    claims = verify_token(token)
+                    if claims['sub'] == user_id:
+                        revoke_token(claims)
+                except TokenError as token_error:
+                    print(f"Logout with unusable token: {token_error}")
             
             return format_json_response({'message': 'Successfully logged out'})
             try:
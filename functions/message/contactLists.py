@@ -0,0 +1,289 @@
+"""Stored, versioned contact lists.
+
+A list is saved once and then changed with deltas; each change is applied
+server-side and written as a new compacted, gzipped version in S3. Versions
+are immutable, so an event only stores the reference "listId@version" and
+repeat campaigns upload just the change instead of the whole recipient list.
+"""
+import gzip
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+import boto3
+
+from bmdata import ContactList
+
+dynamodb = boto3.client('dynamodb')
+s3 = boto3.client('s3')
+
+CONTACT_LIST_PREFIX = 'contact-lists/'
+# Contacts are identified by this field; deltas update and remove by it
+CONTACT_KEY_FIELD = 'phone'
+MAX_CONTACTS = 200000
+MAX_LIST_ID_LENGTH = 128
+DOWNLOAD_URL_EXPIRY_SECONDS = 60 * 60
+# Decoded versions for this warm container; objects are immutable so
+# entries never go stale
+VERSION_CACHE_SIZE = 8
+
+_versions = OrderedDict()
+
+
+def _table():
+    table = os.environ.get('CONTACT_LIST_TABLE')
+    if not table:
+        raise ValueError('CONTACT_LIST_TABLE environment variable is not set')
+    return table
+
+
+def _bucket():
+    bucket = os.environ.get('SENDER_INFO_BUCKET')
+    if not bucket:
+        raise ValueError('SENDER_INFO_BUCKET environment variable is not set')
+    return bucket
+
+
+def parse_list_ref(ref):
+    """Split "listId@version" (version optional, meaning latest)"""
+    list_id, _, version = (ref or '').partition('@')
+    if not list_id:
+        raise ValueError('contactList must look like listId@version')
+    if not version:
+        return list_id, None
+    if not version.isdigit() or int(version) < 1:
+        raise ValueError('contactList version must be a positive integer')
+    return list_id, int(version)
+
+
+def _validate_list_id(list_id):
+    """A client-chosen listId must survive being written as listId@version"""
+    if not isinstance(list_id, str) or not list_id:
+        raise ValueError('listId must be a non-empty string')
+    if '@' in list_id:
+        raise ValueError('listId cannot contain @')
+    if len(list_id) > MAX_LIST_ID_LENGTH:
+        raise ValueError(f'listId can be at most {MAX_LIST_ID_LENGTH} characters')
+
+
+def _contact_key(contact):
+    if not isinstance(contact, dict) or not contact.get(CONTACT_KEY_FIELD):
+        raise ValueError(f'Every contact needs a {CONTACT_KEY_FIELD}')
+    return str(contact[CONTACT_KEY_FIELD])
+
+
+def _index_contacts(contacts):
+    indexed = {}
+    for contact in contacts or []:
+        indexed[_contact_key(contact)] = contact
+    return indexed
+
+
+def _get_row(user_id, list_ref):
+    item = dynamodb.get_item(
+        TableName=_table(),
+        Key={'userId': {'S': user_id}, 'listRef': {'S': list_ref}},
+        ConsistentRead=True
+    ).get('Item')
+    return ContactList.from_item(item) if item else None
+
+
+def _load_version(object_key):
+    cached = _versions.get(object_key)
+    if cached is not None:
+        _versions.move_to_end(object_key)
+        return cached
+
+    body = s3.get_object(Bucket=_bucket(), Key=object_key)['Body']
+    with gzip.GzipFile(fileobj=body) as stream:
+        contacts = _index_contacts(json.load(stream)['contacts'])
+    _remember(object_key, contacts)
+    return contacts
+
+
+def _remember(object_key, contacts):
+    _versions[object_key] = contacts
+    _versions.move_to_end(object_key)
+    while len(_versions) > VERSION_CACHE_SIZE:
+        _versions.popitem(last=False)
+
+
+def apply_delta(contacts, delta):
+    """New contact index from a base index and {add, update, remove}.
+
+    add inserts or replaces whole contacts, update merges fields into an
+    existing contact and remove drops contacts by key. Unknown keys in update
+    or remove are counted rather than rejected, so a delta can be replayed.
+    """
+    merged = dict(contacts)
+    skipped = 0
+    for contact in delta.get('add') or []:
+        merged[_contact_key(contact)] = contact
+    for change in delta.get('update') or []:
+        key = _contact_key(change)
+        if key in merged:
+            merged[key] = dict(merged[key], **change)
+        else:
+            skipped += 1
+    for key in delta.get('remove') or []:
+        if merged.pop(str(key), None) is None:
+            skipped += 1
+    return merged, skipped
+
+
+def _write_version(user_id, list_id, version, contacts):
+    # A unique suffix keeps a losing concurrent writer from overwriting the
+    # object the winning version row points at
+    object_key = f"{CONTACT_LIST_PREFIX}{user_id}/{list_id}/{version}-{uuid.uuid4().hex[:12]}.json.gz"
+    payload = json.dumps({'contacts': list(contacts.values())}, separators=(',', ':')).encode('utf-8')
+    s3.put_object(
+        Bucket=_bucket(),
+        Key=object_key,
+        Body=gzip.compress(payload, compresslevel=6),
+        ContentType='application/json',
+        ContentEncoding='gzip'
+    )
+    return object_key
+
+
+def save_contact_list(user_id, list_id=None, name=None, contacts=None, delta=None, base_version=None):
+    """Create a list from full contacts, or derive its next version from a delta.
+
+    The next version is committed with a transaction conditioned on the
+    list's latestVersion, so two concurrent deltas against the same base
+    cannot both win; the loser gets an error and retries against the latest.
+    """
+    try:
+        if not user_id:
+            raise ValueError('User ID cannot be empty')
+        if contacts is None and delta is None:
+            raise ValueError('contacts or delta is required')
+        if list_id is not None:
+            _validate_list_id(list_id)
+
+        table = _table()
+        now = int(time.time())
+        head = _get_row(user_id, list_id) if list_id else None
+
+        if delta is not None:
+            if not head:
+                raise ValueError('Contact list not found')
+            base_version = int(base_version or head.latest_version)
+            if base_version != head.latest_version:
+                raise ValueError(f'Contact list is at version {head.latest_version}, not {base_version}')
+            base = _get_row(user_id, f"{list_id}@{base_version}")
+            if not base:
+                raise ValueError('Contact list version not found')
+            merged, skipped = apply_delta(_load_version(base.object_key), delta)
+        else:
+            base_version = head.latest_version if head else 0
+            merged, skipped = _index_contacts(contacts), 0
+
+        if len(merged) > MAX_CONTACTS:
+            raise ValueError(f'A contact list can hold at most {MAX_CONTACTS} contacts')
+
+        list_id = list_id or uuid.uuid4().hex
+        version = base_version + 1
+        object_key = _write_version(user_id, list_id, version, merged)
+
+        # An explicit name renames the list; otherwise the first name sticks
+        name_value = ':name' if name else 'if_not_exists(#name, :name)'
+        head_update = {
+            'TableName': table,
+            'Key': {'userId': {'S': user_id}, 'listRef': {'S': list_id}},
+            'UpdateExpression': (
+                f'SET listId = :listId, #name = {name_value}, latestVersion = :version, '
+                'contactCount = :count, createdTime = if_not_exists(createdTime, :now), modifiedTime = :now'
+            ),
+            'ExpressionAttributeNames': {'#name': 'name'},
+            'ExpressionAttributeValues': {
+                ':listId': {'S': list_id},
+                ':name': {'S': name or list_id},
+                ':version': {'N': str(version)},
+                ':count': {'N': str(len(merged))},
+                ':now': {'N': str(now)},
+            },
+        }
+        if base_version:
+            head_update['ConditionExpression'] = 'latestVersion = :base'
+            head_update['ExpressionAttributeValues'][':base'] = {'N': str(base_version)}
+        else:
+            head_update['ConditionExpression'] = 'attribute_not_exists(listRef)'
+
+        version_row = ContactList(
+            user_id=user_id,
+            list_ref=f"{list_id}@{version}",
+            list_id=list_id,
+            version=version,
+            object_key=object_key,
+            contact_count=len(merged),
+            created_time=now,
+        )
+        try:
+            dynamodb.transact_write_items(TransactItems=[
+                {'Update': head_update},
+                {'Put': {
+                    'TableName': table,
+                    'Item': version_row.to_item(),
+                    'ConditionExpression': 'attribute_not_exists(listRef)',
+                }},
+            ])
+        except dynamodb.exceptions.TransactionCanceledException:
+            s3.delete_object(Bucket=_bucket(), Key=object_key)
+            raise ValueError('Contact list was changed concurrently; retry against the latest version')
+
+        _remember(object_key, merged)
+        return {
+            'listId': list_id,
+            'version': version,
+            'contactList': f"{list_id}@{version}",
+            'contactCount': len(merged),
+            'skipped': skipped,
+        }
+    except ValueError as err:
+        print(f"Error saving contact list: {err}")
+        raise
+    except Exception as err:
+        print(f"Error saving contact list: {err}")
+        raise ValueError('Failed to save contact list')
+
+
+def resolve_contact_list(user_id, ref):
+    """Version row for a "listId@version" reference; no version means latest"""
+    list_id, version = parse_list_ref(ref)
+    if version is None:
+        head = _get_row(user_id, list_id)
+        if not head:
+            raise ValueError('Contact list not found')
+        version = head.latest_version
+    row = _get_row(user_id, f"{list_id}@{version}")
+    if not row:
+        raise ValueError('Contact list version not found')
+    return row
+
+
+def get_contact_list(user_id, ref):
+    """Metadata and a download URL for one version of a list"""
+    try:
+        row = resolve_contact_list(user_id, ref)
+        url = s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': _bucket(), 'Key': row.object_key},
+            ExpiresIn=DOWNLOAD_URL_EXPIRY_SECONDS
+        )
+        return {
+            'listId': row.list_id,
+            'version': row.version,
+            'contactList': row.list_ref,
+            'contactCount': row.contact_count,
+            'createdTime': row.created_time,
+            'downloadUrl': url,
+        }
+    except ValueError as err:
+        print(f"Error reading contact list: {err}")
+        raise
+    except Exception as err:
+        print(f"Error reading contact list: {err}")
+        raise ValueError('Failed to read contact list')
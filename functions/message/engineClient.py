@@ -0,0 +1,113 @@
+import time
+
+import requests
+
+from engineReadiness import EngineNotReady
+
+# Never let an engine call run into the Lambda timeout: keep this much of the
+# invocation for writing state and returning a response.
+SAFETY_MARGIN_MS = 1500
+# Upper bound for a single engine call even when the invocation has time left
+DEFAULT_CALL_CAP_SECONDS = 8.0
+# Below this there is no point starting a request
+MIN_CALL_SECONDS = 0.2
+# Used when there is no Lambda context (local runs)
+DEFAULT_BUDGET_MS = 20000
+
+# Circuit breaker: this many consecutive failures open the circuit for
+# OPEN_SECONDS, after which one trial call is let through (half-open).
+FAILURE_THRESHOLD = 3
+OPEN_SECONDS = 30.0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Per-engine breaker state, shared across warm invocations of this container
+_breakers = {}
+
+
+class EngineUnavailable(EngineNotReady):
+    """The engine's circuit is open or the invocation has no time left for the call"""
+
+    def __init__(self, retry_after_ms, message='Engine is unavailable'):
+        super().__init__('unavailable', retry_after_ms, message)
+
+
+class Deadline:
+    """Time budget of the current invocation, from context.get_remaining_time_in_millis()"""
+
+    def __init__(self, context=None, safety_margin_ms=SAFETY_MARGIN_MS):
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            remaining_ms = context.get_remaining_time_in_millis()
+        else:
+            remaining_ms = DEFAULT_BUDGET_MS
+        self.expires_at = time.monotonic() + max(0, remaining_ms - safety_margin_ms) / 1000.0
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def timeout(self, cap=DEFAULT_CALL_CAP_SECONDS):
+        """Timeout for the next outbound call; raises if the budget is spent"""
+        timeout = min(cap, self.remaining())
+        if timeout < MIN_CALL_SECONDS:
+            raise EngineUnavailable(0, 'Not enough time left to call the engine')
+        return timeout
+
+
+class CircuitBreaker:
+    __slots__ = ('state', 'failures', 'opened_at')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def before_call(self):
+        if self.state == CLOSED:
+            return
+        # Open, or half-open with a trial call started less than a window ago
+        waited = time.monotonic() - self.opened_at
+        if waited < OPEN_SECONDS:
+            raise EngineUnavailable(int((OPEN_SECONDS - waited) * 1000))
+        self.state = HALF_OPEN
+        self.opened_at = time.monotonic()
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= FAILURE_THRESHOLD:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+def get_breaker(public_url):
+    breaker = _breakers.get(public_url)
+    if breaker is None:
+        breaker = _breakers[public_url] = CircuitBreaker()
+    return breaker
+
+
+def engine_request(method, public_url, path, deadline, cap=DEFAULT_CALL_CAP_SECONDS, **kwargs):
+    """Call an engine endpoint within the invocation's deadline, behind its breaker.
+
+    Connection errors, timeouts and 5xx answers count against the breaker;
+    4xx answers mean the engine is alive and are left to the caller.
+    """
+    breaker = get_breaker(public_url)
+    breaker.before_call()
+    timeout = deadline.timeout(cap)
+    try:
+        response = requests.request(method, f"http://{public_url}{path}", timeout=timeout, **kwargs)
+    except requests.RequestException:
+        breaker.record_failure()
+        raise
+
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
@@ -0,0 +1,225 @@
+"""Per-engine priority lanes for outbound sends.
+
+Every invocation that wants to call an engine's /sendMessage first takes a
+slot on that engine's gate row in bm-engine-lanes. The row keeps an atomic
+inFlight counter next to one lease attribute per held slot: a slot is taken
+by a single conditional ADD checked against the lane's limit, and given back
+by an ADD of -1 that removes the lease, so senders never read-modify-write
+the row and never contend on anything but the counter itself.
+
+Lanes differ only in how full the engine may be when they take a slot.
+Interactive sends may use every slot; transactional sends leave
+INTERACTIVE_RESERVE free and bulk sends leave TRANSACTIONAL_RESERVE more, so
+a one-off message is not queued behind a saturating broadcast. A bulk sender
+that has waited BULK_MAX_WAIT_MS is promoted to the transactional limit so
+steady transactional traffic cannot starve a campaign.
+
+A sender that finds its lane full waits on cheap, eventually consistent reads
+and only tries the conditional write again once the row shows room. Leases
+of crashed holders are reclaimed by those waiters once they expire.
+"""
+import os
+import random
+import time
+import uuid
+
+import boto3
+
+from bmdata import decode_item
+from engineClient import EngineUnavailable
+
+dynamodb = boto3.client('dynamodb')
+
+INTERACTIVE = 'interactive'
+TRANSACTIONAL = 'transactional'
+BULK = 'bulk'
+LANES = (INTERACTIVE, TRANSACTIONAL, BULK)
+
+# Concurrent sends one engine is allowed to work on
+LANE_CAPACITY = int(os.environ.get('ENGINE_LANE_CAPACITY', '8'))
+INTERACTIVE_RESERVE = 2
+TRANSACTIONAL_RESERVE = 1
+# Highest inFlight count at which each lane may still take a slot
+LANE_LIMITS = {
+    INTERACTIVE: LANE_CAPACITY,
+    TRANSACTIONAL: max(1, LANE_CAPACITY - INTERACTIVE_RESERVE),
+    BULK: max(1, LANE_CAPACITY - INTERACTIVE_RESERVE - TRANSACTIONAL_RESERVE),
+}
+BULK_MAX_WAIT_MS = 5000
+# A lease outlives the longest engine call; a crashed holder frees it then
+LEASE_MS = 10000
+LEASE_PREFIX = 'lease_'
+POLL_MIN_SECONDS = 0.05
+POLL_MAX_SECONDS = 0.25
+# Never wait longer than this, whatever the invocation has left
+MAX_WAIT_SECONDS = 8.0
+BUSY_RETRY_MS = 1000
+
+
+def _table():
+    table = os.environ.get('ENGINE_LANE_TABLE')
+    if not table:
+        raise ValueError('ENGINE_LANE_TABLE environment variable is not set')
+    return table
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def lane_for(body):
+    """Explicit lane from the request, else bulk for campaign sends, else interactive"""
+    lane = body.get('lane')
+    if lane:
+        if lane not in LANES:
+            raise ValueError(f"lane must be one of {', '.join(LANES)}")
+        return lane
+    return BULK if body.get('eventId') else INTERACTIVE
+
+
+def _limit(lane, waited_ms):
+    if lane == BULK and waited_ms >= BULK_MAX_WAIT_MS:
+        # Starvation guard: an aged bulk sender competes as transactional
+        return LANE_LIMITS[TRANSACTIONAL]
+    return LANE_LIMITS[lane]
+
+
+def _try_acquire(table, engine_key, lane, limit, lease_id, wait_ms):
+    """Take a slot if fewer than `limit` are in use; False when the lane is full"""
+    try:
+        dynamodb.update_item(
+            TableName=table,
+            Key={'engineKey': {'S': engine_key}},
+            UpdateExpression=(
+                'SET #lease = :lease, #lastWait = :wait '
+                'ADD inFlight :one, #served :one, #waitTotal :wait'
+            ),
+            ConditionExpression='attribute_not_exists(inFlight) OR inFlight < :limit',
+            ExpressionAttributeNames={
+                '#lease': LEASE_PREFIX + lease_id,
+                '#lastWait': f'{lane}LastWaitMs',
+                '#served': f'{lane}Served',
+                '#waitTotal': f'{lane}WaitMsTotal',
+            },
+            ExpressionAttributeValues={
+                ':lease': {'M': {'l': {'S': lane}, 'e': {'N': str(_now_ms() + LEASE_MS)}}},
+                ':wait': {'N': str(wait_ms)},
+                ':one': {'N': '1'},
+                ':limit': {'N': str(limit)},
+            }
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def _drop_lease(table, engine_key, lease_id, expired_before=None):
+    """Remove a lease and give its slot back, exactly once.
+
+    With expired_before, only a lease that expired by then is reclaimed, so a
+    waiter cannot take the slot of a holder that is still sending.
+    """
+    condition = 'attribute_exists(#lease)'
+    values = {':minus': {'N': '-1'}}
+    if expired_before is not None:
+        condition = '#lease.e < :now'
+        values[':now'] = {'N': str(expired_before)}
+    try:
+        dynamodb.update_item(
+            TableName=table,
+            Key={'engineKey': {'S': engine_key}},
+            UpdateExpression='REMOVE #lease ADD inFlight :minus',
+            ConditionExpression=condition,
+            ExpressionAttributeNames={'#lease': LEASE_PREFIX + lease_id},
+            ExpressionAttributeValues=values
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        # Already released or reclaimed
+        return False
+
+
+def _read(table, engine_key, consistent=False):
+    item = dynamodb.get_item(
+        TableName=table,
+        Key={'engineKey': {'S': engine_key}},
+        ConsistentRead=consistent
+    ).get('Item')
+    return decode_item(item) if item else {}
+
+
+def _leases(state):
+    return {
+        name[len(LEASE_PREFIX):]: lease
+        for name, lease in state.items() if name.startswith(LEASE_PREFIX)
+    }
+
+
+def _reclaim_expired(table, engine_key, state, now):
+    """Give back the slots of holders that crashed; returns how many were freed"""
+    freed = 0
+    for lease_id, lease in _leases(state).items():
+        if lease['e'] < now and _drop_lease(table, engine_key, lease_id, expired_before=now):
+            freed += 1
+    return freed
+
+
+def acquire_slot(engine_key, lane, deadline):
+    """Wait for a send slot on the engine; returns the lease id to release.
+
+    Raises EngineUnavailable with a retry hint when no slot frees up within
+    the wait budget, which the handler turns into a 503.
+    """
+    table = _table()
+    lease_id = uuid.uuid4().hex
+    since = _now_ms()
+    give_up_at = time.monotonic() + min(MAX_WAIT_SECONDS, max(0.0, deadline.remaining() - 1.0))
+
+    while True:
+        waited_ms = _now_ms() - since
+        if _try_acquire(table, engine_key, lane, _limit(lane, waited_ms), lease_id, waited_ms):
+            return lease_id
+
+        # Wait on reads until the row shows room; failed writes would only add contention
+        while True:
+            if time.monotonic() >= give_up_at:
+                raise EngineUnavailable(BUSY_RETRY_MS, f'Engine {lane} lane is busy')
+            time.sleep(random.uniform(POLL_MIN_SECONDS, POLL_MAX_SECONDS))
+            now = _now_ms()
+            state = _read(table, engine_key)
+            in_flight = state.get('inFlight', 0) - _reclaim_expired(table, engine_key, state, now)
+            if in_flight < _limit(lane, now - since):
+                break
+
+
+def release_slot(engine_key, lease_id):
+    """Give a slot back; never raises, an unreleased lease expires after LEASE_MS"""
+    try:
+        _drop_lease(_table(), engine_key, lease_id)
+    except Exception as err:
+        print(f"Error releasing engine slot: {err}")
+
+
+def lane_stats(engine_key):
+    """Slot limits, slots in use and wait times per lane for one engine"""
+    try:
+        state = _read(_table(), engine_key, consistent=True)
+        now = _now_ms()
+        in_flight = dict.fromkeys(LANES, 0)
+        for lease in _leases(state).values():
+            if lease['e'] > now and lease['l'] in in_flight:
+                in_flight[lease['l']] += 1
+        lanes = {}
+        for lane in LANES:
+            served = state.get(f'{lane}Served', 0)
+            lanes[lane] = {
+                'limit': LANE_LIMITS[lane],
+                'inFlight': in_flight[lane],
+                'served': served,
+                'avgWaitMs': int(state.get(f'{lane}WaitMsTotal', 0) / served) if served else 0,
+                'lastWaitMs': state.get(f'{lane}LastWaitMs', 0),
+            }
+        return {'capacity': LANE_CAPACITY, 'inFlight': state.get('inFlight', 0), 'lanes': lanes}
+    except Exception as err:
+        print(f"Error reading lane stats: {err}")
+        raise ValueError('Failed to read lane stats')
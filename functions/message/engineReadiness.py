@@ -0,0 +1,64 @@
+import os
+import random
+
+import requests
+
+# Engine lifecycle, stored as engineState on the bm-engine-instances row:
+#   launching -> booting -> ready -> linked -> draining -> terminated
+# launching: EC2 (or the shared host) is not running / has no public IP yet
+# booting:   reachable IP, but the container is not answering its health check
+# ready:     health check passed, QR code can be fetched
+# linked:    WhatsApp session linked (loginStatus returned true)
+# draining:  termination in progress
+LAUNCHING = 'launching'
+BOOTING = 'booting'
+READY = 'ready'
+LINKED = 'linked'
+DRAINING = 'draining'
+TERMINATED = 'terminated'
+
+SERVING_STATES = (READY, LINKED)
+
+ENGINE_HEALTH_PATH = os.environ.get('ENGINE_HEALTH_PATH', '/health')
+HEALTH_PROBE_TIMEOUT_SECONDS = 1.5
+
+# Poll hints per state: first hint, growth per unsuccessful probe, and cap.
+# An EC2 engine usually needs 30-60 s to launch and a few more to boot.
+RETRY_POLICY = {
+    LAUNCHING: (5000, 1.5, 15000),
+    BOOTING: (2000, 1.5, 8000),
+}
+DEFAULT_RETRY_MS = 3000
+
+
+class EngineNotReady(ValueError):
+    """The engine exists but cannot serve requests yet; carries a poll hint"""
+
+    def __init__(self, engine_state, retry_after_ms, message='Engine is not ready yet'):
+        super().__init__(message)
+        self.engine_state = engine_state
+        self.retry_after_ms = retry_after_ms
+
+
+def retry_after_ms(engine_state, probe_count=0):
+    """Backoff hint for clients polling an engine that is not ready yet"""
+    if engine_state in SERVING_STATES:
+        return 0
+    first, growth, cap = RETRY_POLICY.get(engine_state, (DEFAULT_RETRY_MS, 1, DEFAULT_RETRY_MS))
+    delay = min(cap, first * growth ** (probe_count or 0))
+    # +/-10% jitter keeps a batch of onboarding clients from polling in lockstep
+    return int(delay * random.uniform(0.9, 1.1))
+
+
+def probe_engine_health(public_url, timeout=HEALTH_PROBE_TIMEOUT_SECONDS):
+    """True once the engine container answers its health endpoint.
+
+    Any non-5xx answer counts: it proves the container's HTTP server is up,
+    which is all the QR code and login calls need, even on engine images that
+    predate the health route.
+    """
+    try:
+        response = requests.get(f"http://{public_url}{ENGINE_HEALTH_PATH}", timeout=timeout)
+        return response.status_code < 500
+    except requests.RequestException:
+        return False
@@ -0,0 +1,198 @@
+"""Per-recipient result exports of a broadcast.
+
+The event's delivery ledger is paged through with Query, each page is
+rendered as CSV or NDJSON, gzipped incrementally and shipped to S3 as
+multipart-upload parts. Only one ledger page and one part are in memory at
+a time, so the export of a 200k-recipient campaign uses the same memory as
+a small one.
+"""
+import csv
+import io
+import json
+import os
+import time
+import zlib
+
+import boto3
+
+from bmdata import LedgerEntry
+
+dynamodb = boto3.client('dynamodb')
+s3 = boto3.client('s3')
+
+EXPORT_PREFIX = 'exports/'
+EXPORT_FORMATS = ('csv', 'ndjson')
+# S3 parts must be at least 5 MB, except the last one
+PART_SIZE = 8 * 1024 * 1024
+DOWNLOAD_URL_EXPIRY_SECONDS = 60 * 60
+# Stop paging with this much of the invocation left to finish the upload
+FINISH_MARGIN_SECONDS = 3.0
+
+EXPORT_SLOTS = (
+    'recipient', 'status', 'message_id', 'sent_time', 'delivered_time',
+    'read_time', 'failed_time', 'error_code', 'updated_time',
+)
+EXPORT_COLUMNS = tuple(dict((slot, name) for slot, name, _ in LedgerEntry.FIELDS)[slot] for slot in EXPORT_SLOTS)
+
+
+def _bucket():
+    bucket = os.environ.get('SENDER_INFO_BUCKET')
+    if not bucket:
+        raise ValueError('SENDER_INFO_BUCKET environment variable is not set')
+    return bucket
+
+
+def _ledger_table():
+    table = os.environ.get('DELIVERY_LEDGER_TABLE')
+    if not table:
+        raise ValueError('DELIVERY_LEDGER_TABLE environment variable is not set')
+    return table
+
+
+def _ledger_pages(event_id):
+    params = {
+        'TableName': _ledger_table(),
+        'KeyConditionExpression': 'eventId = :eventId',
+        'ExpressionAttributeValues': {':eventId': {'S': event_id}},
+        **LedgerEntry.projection(*EXPORT_SLOTS),
+    }
+    while True:
+        response = dynamodb.query(**params)
+        yield response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+class _RowEncoder:
+    """Renders ledger rows as CSV or NDJSON text, one page at a time"""
+
+    def __init__(self, export_format):
+        self.export_format = export_format
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text) if export_format == 'csv' else None
+
+    def header(self):
+        if self.writer is None:
+            return b''
+        self.writer.writerow(EXPORT_COLUMNS)
+        return self._drain()
+
+    def encode(self, items):
+        for item in items:
+            entry = LedgerEntry.from_item(item)
+            values = [getattr(entry, slot) for slot in EXPORT_SLOTS]
+            if self.writer is not None:
+                self.writer.writerow(['' if value is None else value for value in values])
+            else:
+                self.text.write(json.dumps(dict(zip(EXPORT_COLUMNS, values)), separators=(',', ':')))
+                self.text.write('\n')
+        return self._drain()
+
+    def _drain(self):
+        data = self.text.getvalue().encode('utf-8')
+        self.text.seek(0)
+        self.text.truncate()
+        return data
+
+
+class _MultipartWriter:
+    """Gzips bytes into PART_SIZE parts of one S3 multipart upload"""
+
+    def __init__(self, bucket, key, content_type):
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = s3.create_multipart_upload(
+            Bucket=bucket, Key=key, ContentType=content_type, ContentEncoding='gzip'
+        )['UploadId']
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        self.buffer = bytearray()
+        self.parts = []
+        self.raw_bytes = 0
+
+    def write(self, data):
+        self.raw_bytes += len(data)
+        self.buffer += self.compressor.compress(data)
+        if len(self.buffer) >= PART_SIZE:
+            self._flush_part()
+
+    def _flush_part(self):
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self.buffer)
+        )
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.buffer.clear()
+
+    def close(self):
+        self.buffer += self.compressor.flush()
+        self._flush_part()
+        s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def export_event_results(user_id, event_id, event_table, deadline, export_format='csv'):
+    """Stream an event's per-recipient results to S3; returns a presigned download URL"""
+    try:
+        if not user_id or not event_id:
+            raise ValueError('User ID and Event ID cannot be empty')
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+
+        # Only the event's owner may export it
+        owned = dynamodb.get_item(
+            TableName=event_table,
+            Key={'userId': {'S': user_id}, 'eventId': {'S': event_id}},
+            ProjectionExpression='eventId'
+        ).get('Item')
+        if not owned:
+            raise ValueError('Event not found')
+
+        bucket = _bucket()
+        file_name = f"{event_id}.{export_format}.gz"
+        key = f"{EXPORT_PREFIX}{user_id}/{int(time.time())}-{file_name}"
+        content_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        encoder = _RowEncoder(export_format)
+        writer = _MultipartWriter(bucket, key, content_type)
+        rows = 0
+        try:
+            writer.write(encoder.header())
+            for items in _ledger_pages(event_id):
+                if deadline.remaining() < FINISH_MARGIN_SECONDS:
+                    raise ValueError('Export did not finish within the request time limit')
+                writer.write(encoder.encode(items))
+                rows += len(items)
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+
+        url = s3.generate_presigned_url(
+            'get_object',
+            Params={
+                'Bucket': bucket,
+                'Key': key,
+                'ResponseContentDisposition': f'attachment; filename="{file_name}"',
+            },
+            ExpiresIn=DOWNLOAD_URL_EXPIRY_SECONDS
+        )
+        return {
+            'eventId': event_id,
+            'format': export_format,
+            'rows': rows,
+            'uncompressedBytes': writer.raw_bytes,
+            'parts': len(writer.parts),
+            'downloadUrl': url,
+        }
+    except ValueError as err:
+        print(f"Error exporting event results: {err}")
+        raise
+    except Exception as err:
+        print(f"Error exporting event results: {err}")
+        raise ValueError('Failed to export event results')
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import boto3
+
+dynamodb = boto3.client('dynamodb')
+
+# How long a completed response is replayed for the same key
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+# An in-progress claim older than this belongs to a crashed invocation and may
+# be taken over (the Lambda timeout is 20 s)
+IN_PROGRESS_LOCK_SECONDS = 30
+LOCAL_CACHE_SIZE = 1024
+
+IN_PROGRESS = 'IN_PROGRESS'
+COMPLETED = 'COMPLETED'
+
+# Completed responses for this warm container: key -> (expiresAt, requestHash, response)
+_local_cache = OrderedDict()
+
+# Body fields that do not change what the request does
+_IGNORED_FIELDS = ('token', 'idempotencyKey')
+
+
+class RequestInProgress(ValueError):
+    """The same idempotency key is being processed by another invocation"""
+
+    def __init__(self, retry_after_ms, message='A request with this idempotency key is still in progress'):
+        super().__init__(message)
+        self.retry_after_ms = retry_after_ms
+
+
+def get_idempotency_key(event, body):
+    headers = event.get('headers') or {}
+    return headers.get('idempotency-key') or headers.get('Idempotency-Key') or body.get('idempotencyKey')
+
+
+def request_fingerprint(body):
+    payload = {name: value for name, value in body.items() if name not in _IGNORED_FIELDS}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _table():
+    table = os.environ.get('IDEMPOTENCY_TABLE')
+    if not table:
+        raise ValueError('IDEMPOTENCY_TABLE environment variable is not set')
+    return table
+
+
+def _remember(record_key, expires_at, request_hash, response):
+    _local_cache[record_key] = (expires_at, request_hash, response)
+    _local_cache.move_to_end(record_key)
+    while len(_local_cache) > LOCAL_CACHE_SIZE:
+        _local_cache.popitem(last=False)
+
+
+def _replay(record_key, request_hash, expires_at, stored_hash, response):
+    if stored_hash != request_hash:
+        raise ValueError('Idempotency key was already used for a different request')
+    _remember(record_key, expires_at, stored_hash, response)
+    return response
+
+
+def run_idempotent(scope, idempotency_key, request_hash, action):
+    """Run action at most once per (scope, key) within the TTL window.
+
+    Without a key the action simply runs. With one, the first caller claims
+    the key with a conditional put and stores the action's result; retries
+    get that stored result back without redoing the work. Failed actions
+    release the key so the client can retry them.
+    """
+    if not idempotency_key:
+        return action()
+
+    record_key = f"{scope}#{idempotency_key}"
+    now = int(time.time())
+
+    cached = _local_cache.get(record_key)
+    if cached and cached[0] > now:
+        return _replay(record_key, request_hash, *cached)
+
+    table = _table()
+    try:
+        dynamodb.put_item(
+            TableName=table,
+            Item={
+                'idempotencyKey': {'S': record_key},
+                'recordStatus': {'S': IN_PROGRESS},
+                'requestHash': {'S': request_hash},
+                'lockExpiresAt': {'N': str(now + IN_PROGRESS_LOCK_SECONDS)},
+                'expiresAt': {'N': str(now + IDEMPOTENCY_TTL_SECONDS)},
+            },
+            ConditionExpression=(
+                'attribute_not_exists(idempotencyKey) OR expiresAt < :now '
+                'OR (recordStatus = :inProgress AND lockExpiresAt < :now)'
+            ),
+            ExpressionAttributeValues={
+                ':now': {'N': str(now)},
+                ':inProgress': {'S': IN_PROGRESS},
+            }
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        existing = dynamodb.get_item(
+            TableName=table,
+            Key={'idempotencyKey': {'S': record_key}},
+            ConsistentRead=True
+        ).get('Item', {})
+        if existing.get('recordStatus', {}).get('S') == COMPLETED:
+            return _replay(
+                record_key,
+                request_hash,
+                int(existing['expiresAt']['N']),
+                existing['requestHash']['S'],
+                json.loads(existing['response']['S'])
+            )
+        lock_expires_at = int(existing.get('lockExpiresAt', {}).get('N', now))
+        raise RequestInProgress(max(1000, (lock_expires_at - now) * 1000))
+
+    try:
+        response = action()
+    except Exception:
+        dynamodb.delete_item(TableName=table, Key={'idempotencyKey': {'S': record_key}})
+        raise
+
+    expires_at = now + IDEMPOTENCY_TTL_SECONDS
+    dynamodb.update_item(
+        TableName=table,
+        Key={'idempotencyKey': {'S': record_key}},
+        UpdateExpression='SET recordStatus = :completed, #response = :response REMOVE lockExpiresAt',
+        ExpressionAttributeNames={'#response': 'response'},
+        ExpressionAttributeValues={
+            ':completed': {'S': COMPLETED},
+            ':response': {'S': json.dumps(response)},
+        }
+    )
+    _remember(record_key, expires_at, request_hash, response)
+    return response
@@ -0,0 +1,147 @@
+"""Single-flight lease on a user's engine launch.
+
+The first create for a user writes a lease onto the user row with a
+conditional update and launches the engine; concurrent creates find the
+lease taken and wait for its instanceId instead of launching their own.
+When the launch finishes, the lease keeps pointing at the new instance for
+COALESCE_SECONDS so late duplicates (double clicks, client retries) get the
+same instanceId too. A lease whose holder crashed expires on its own.
+
+A lease is only granted while the user has no active engine, and the
+pointer is only written by the lease holder onto an empty slot, so a create
+outside the coalescing window gets the existing engine instead of
+orphaning it behind a second one.
+"""
+import time
+import uuid
+
+import boto3
+
+from bmdata import User
+from idempotency import RequestInProgress
+
+dynamodb = boto3.client('dynamodb')
+
+# Longer than the Lambda timeout, so only a crashed holder's lease expires
+LEASE_SECONDS = 30
+# How long a finished launch is handed to duplicate creates
+COALESCE_SECONDS = 30
+POLL_SECONDS = 0.5
+
+
+def _user_key(user_id):
+    return {'userId': {'S': user_id}}
+
+
+def acquire_launch_lease(user_table, user_id):
+    """Lease id if this call should launch, None if another launch holds the lease
+    or the user already has an active engine"""
+    lease_id = uuid.uuid4().hex
+    now = int(time.time())
+    try:
+        dynamodb.update_item(
+            TableName=user_table,
+            Key=_user_key(user_id),
+            UpdateExpression=(
+                'SET engineLeaseId = :leaseId, engineLeaseExpiresAt = :expiresAt '
+                'REMOVE engineLeaseInstanceId'
+            ),
+            ConditionExpression=(
+                'attribute_exists(userId) AND attribute_not_exists(activeInstanceId) AND '
+                '(attribute_not_exists(engineLeaseId) OR engineLeaseExpiresAt < :now)'
+            ),
+            ExpressionAttributeValues={
+                ':leaseId': {'S': lease_id},
+                ':expiresAt': {'N': str(now + LEASE_SECONDS)},
+                ':now': {'N': str(now)},
+            }
+        )
+        return lease_id
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return None
+
+
+def complete_launch_lease(user_table, user_id, lease_id, instance_id, modified_time):
+    """Transaction Update that points the user at the new engine and publishes it to waiters.
+
+    Conditioned on still holding the lease and on the user having no active
+    engine, so a launch that outlived its lease cannot overwrite the pointer
+    written by its successor.
+    """
+    return {
+        'Update': {
+            'TableName': user_table,
+            'Key': _user_key(user_id),
+            'UpdateExpression': (
+                'SET activeInstanceId = :instanceId, modifiedTime = :modifiedTime, '
+                'engineLeaseInstanceId = :instanceId, engineLeaseExpiresAt = :coalesceUntil'
+            ),
+            'ConditionExpression': 'engineLeaseId = :leaseId AND attribute_not_exists(activeInstanceId)',
+            'ExpressionAttributeValues': {
+                ':instanceId': {'S': instance_id},
+                ':modifiedTime': {'N': str(modified_time)},
+                ':coalesceUntil': {'N': str(int(time.time()) + COALESCE_SECONDS)},
+                ':leaseId': {'S': lease_id},
+            }
+        }
+    }
+
+
+def release_launch_lease(user_table, user_id, lease_id):
+    """Drop the lease after a failed launch so the next create can try again"""
+    try:
+        dynamodb.update_item(
+            TableName=user_table,
+            Key=_user_key(user_id),
+            UpdateExpression='REMOVE engineLeaseId, engineLeaseExpiresAt, engineLeaseInstanceId',
+            ConditionExpression='engineLeaseId = :leaseId',
+            ExpressionAttributeValues={':leaseId': {'S': lease_id}}
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        pass
+
+
+def clear_active_engine(user_table, user_id, instance_id):
+    """Drop a pointer to an engine that is no longer running, if it still points there"""
+    try:
+        dynamodb.update_item(
+            TableName=user_table,
+            Key=_user_key(user_id),
+            UpdateExpression='REMOVE activeInstanceId',
+            ConditionExpression='activeInstanceId = :instanceId',
+            ExpressionAttributeValues={':instanceId': {'S': instance_id}}
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        pass
+
+
+def wait_for_launch(user_table, user_id, deadline):
+    """instanceId of the launch holding the lease, else the user's active engine.
+
+    Returns None once the lease has lapsed and there is no active engine.
+
+    Raises RequestInProgress when the launch is still running as the
+    invocation's budget runs out; the client retries after the hint.
+    """
+    projection = User.projection(
+        'engine_lease_id', 'engine_lease_expires_at', 'engine_lease_instance_id', 'active_instance_id'
+    )
+    while True:
+        item = dynamodb.get_item(
+            TableName=user_table,
+            Key=_user_key(user_id),
+            ConsistentRead=True,
+            **projection
+        ).get('Item')
+        user = User.from_item(item or {})
+        now = int(time.time())
+        if not user.engine_lease_id or (user.engine_lease_expires_at or 0) < now:
+            return user.active_instance_id
+        if user.engine_lease_instance_id:
+            return user.engine_lease_instance_id
+        if deadline.remaining() < POLL_SECONDS * 2:
+            raise RequestInProgress(
+                max(1000, (user.engine_lease_expires_at - now) * 1000 // 4),
+                'An engine launch for this user is still in progress'
+            )
+        time.sleep(POLL_SECONDS)
@@ -0,0 +1,174 @@
+"""Content-addressed media for broadcast attachments.
+
+Media is stored once in S3 under media/<sha256> and messages carry only a
+reference: {"media": {"sha256": ..., "contentType": ..., "fileName": ...}}.
+Before forwarding a message to the engine the reference is expanded with a
+presigned mediaUrl; the engine downloads each sha256 once and keeps the blob
+in its own size-bounded LRU cache, so a broadcast ships the bytes to the
+engine once instead of once per recipient.
+"""
+import base64
+import binascii
+import hashlib
+import os
+import re
+import time
+from collections import OrderedDict
+
+import boto3
+from botocore.exceptions import ClientError
+
+s3 = boto3.client('s3')
+
+MEDIA_PREFIX = 'media/'
+MAX_MEDIA_BYTES = 100 * 1024 * 1024
+UPLOAD_URL_EXPIRY_SECONDS = 15 * 60
+DOWNLOAD_URL_EXPIRY_SECONDS = 60 * 60
+# Reuse a presigned GET URL while it has at least this long left
+DOWNLOAD_URL_MIN_REMAINING_SECONDS = 10 * 60
+URL_CACHE_SIZE = 256
+
+_SHA256_HEX = re.compile(r'^[0-9a-f]{64}$')
+
+# sha256 -> (expiresAt, presigned GET URL); warm-container LRU so a broadcast
+# does not re-sign (or re-check) the same attachment for every recipient
+_download_urls = OrderedDict()
+
+
+def _bucket():
+    bucket = os.environ.get('MEDIA_BUCKET')
+    if not bucket:
+        raise ValueError('MEDIA_BUCKET environment variable is not set')
+    return bucket
+
+
+def _media_key(sha256):
+    return f"{MEDIA_PREFIX}{sha256}"
+
+
+def _validate_sha256(sha256):
+    sha256 = (sha256 or '').lower()
+    if not _SHA256_HEX.match(sha256):
+        raise ValueError('sha256 must be a 64 character hex digest')
+    return sha256
+
+
+def media_exists(sha256):
+    try:
+        s3.head_object(Bucket=_bucket(), Key=_media_key(sha256))
+        return True
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def prepare_media_upload(sha256, content_type, size):
+    """Presigned PUT for media the client hashed itself; skipped if already stored.
+
+    Uploading straight to S3 keeps large attachments out of the Lambda
+    request, and the checksum makes S3 reject bytes that do not match the hash.
+    """
+    sha256 = _validate_sha256(sha256)
+    if not content_type:
+        raise ValueError('contentType is required')
+    if not size or int(size) <= 0 or int(size) > MAX_MEDIA_BYTES:
+        raise ValueError(f'size must be between 1 and {MAX_MEDIA_BYTES} bytes')
+
+    if media_exists(sha256):
+        return {'sha256': sha256, 'exists': True}
+
+    checksum = base64.b64encode(bytes.fromhex(sha256)).decode('ascii')
+    upload_url = s3.generate_presigned_url(
+        'put_object',
+        Params={
+            'Bucket': _bucket(),
+            'Key': _media_key(sha256),
+            'ContentType': content_type,
+            'ContentLength': int(size),
+            'ChecksumSHA256': checksum,
+        },
+        ExpiresIn=UPLOAD_URL_EXPIRY_SECONDS
+    )
+    return {
+        'sha256': sha256,
+        'exists': False,
+        'uploadUrl': upload_url,
+        'uploadHeaders': {
+            'Content-Type': content_type,
+            'x-amz-checksum-sha256': checksum,
+        },
+    }
+
+
+def store_inline_media(data, content_type):
+    """Store base64 media sent in the request body; returns its sha256"""
+    try:
+        raw = base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError('media data must be base64 encoded')
+    if len(raw) > MAX_MEDIA_BYTES:
+        raise ValueError('media is too large')
+
+    sha256 = hashlib.sha256(raw).hexdigest()
+    if sha256 not in _download_urls and not media_exists(sha256):
+        s3.put_object(
+            Bucket=_bucket(),
+            Key=_media_key(sha256),
+            Body=raw,
+            ContentType=content_type or 'application/octet-stream'
+        )
+    return sha256
+
+
+def get_media_url(sha256):
+    now = time.time()
+    cached = _download_urls.get(sha256)
+    if cached and cached[0] - now > DOWNLOAD_URL_MIN_REMAINING_SECONDS:
+        _download_urls.move_to_end(sha256)
+        return cached[1]
+
+    url = s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': _bucket(), 'Key': _media_key(sha256)},
+        ExpiresIn=DOWNLOAD_URL_EXPIRY_SECONDS
+    )
+    _download_urls[sha256] = (now + DOWNLOAD_URL_EXPIRY_SECONDS, url)
+    _download_urls.move_to_end(sha256)
+    while len(_download_urls) > URL_CACHE_SIZE:
+        _download_urls.popitem(last=False)
+    return url
+
+
+def store_media_reference(message):
+    """Message with inline media moved to S3 and replaced by its sha256.
+
+    What is kept for a later retry: the stored copy stays small and the
+    fetch URL is signed again when the retry is sent.
+    """
+    media = message.get('media') if isinstance(message, dict) else None
+    if not media or not media.get('data'):
+        return message
+    sha256 = store_inline_media(media['data'], media.get('contentType'))
+    reference = {name: value for name, value in media.items() if name not in ('data', 'mediaUrl')}
+    reference['sha256'] = sha256
+    return dict(message, media=reference)
+
+
+def resolve_media_reference(message):
+    """Turn a message's media (reference or inline data) into a hash + fetch URL"""
+    media = message.get('media') if isinstance(message, dict) else None
+    if not media:
+        return message
+
+    if media.get('data'):
+        sha256 = store_inline_media(media['data'], media.get('contentType'))
+    else:
+        sha256 = _validate_sha256(media.get('sha256'))
+        if sha256 not in _download_urls and not media_exists(sha256):
+            raise ValueError('Media has not been uploaded')
+
+    resolved = {name: value for name, value in media.items() if name != 'data'}
+    resolved['sha256'] = sha256
+    resolved['mediaUrl'] = get_media_url(sha256)
+    return dict(message, media=resolved)
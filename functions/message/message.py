@@ -6,10 +6,36 @@ import os
 import json
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from ec2Client import create_aws_ec2_instance, call_describe_instances, terminate_aws_ec2_instance
+from ec2Client import launch_engine_instance, call_describe_instances, terminate_aws_ec2_instance
+from sessionToken import verify_token, get_token_from_event, redact_event
+from bmdata import User, Subscription, EngineInstance, Event
+from engineReadiness import (
+    LAUNCHING, BOOTING, READY, LINKED, DRAINING, TERMINATED, SERVING_STATES,
+    EngineNotReady, retry_after_ms, probe_engine_health, HEALTH_PROBE_TIMEOUT_SECONDS
+)
+from engineClient import Deadline, engine_request
+from mediaStore import prepare_media_upload, store_inline_media, store_media_reference, resolve_media_reference
+from idempotency import get_idempotency_key, request_fingerprint, run_idempotent, RequestInProgress
+from requestBody import parse_body
+from engineLanes import INTERACTIVE, lane_for, acquire_slot, release_slot, lane_stats
+from sendRetries import classify_error, enqueue_failed_send, drain_retries
+from exports import export_event_results
+from receipts import verify_signature, ingest_receipts, record_sent
+from contactLists import save_contact_list, get_contact_list, resolve_contact_list
+from launchLease import (
+    acquire_launch_lease, complete_launch_lease, release_launch_lease, wait_for_launch, clear_active_engine
+)
+from activeEngine import backfill_active_instance_id
+from engineHosts import is_shared_mode, assign_session, ensure_session_container, get_session_endpoint, release_session
 
 dynamodb = boto3.client('dynamodb')
 
+# Actions that operate on the user's current engine; when the client omits
+# instanceId it is resolved from the active-engine pointer on the user row.
+ENGINE_ACTIONS = ('status', 'loginStatus', 'startBroadCast', 'updateBroadCast', 'logout', 'terminate')
+# A create that finds the launch lease lapsed tries to take it over this often
+MAX_LEASE_ATTEMPTS = 3
+
 def get_db_params(table, user_id):
     if not table or not user_id:
         raise ValueError('Table name and User ID cannot be empty')
@@ -26,9 +52,9 @@ def validate_user(user_id, user_table):
             raise ValueError('User ID cannot be empty')
 
         db_params = get_db_params(user_table, user_id)
-        user_info = dynamodb.get_item(**db_params).get('Item')
+        user_info = dynamodb.get_item(**db_params, **User.projection('is_active')).get('Item')
 
-        if not user_info or not user_info.get('isActive', {}).get('BOOL'):
+        if not user_info or not User.from_item(user_info).is_active:
             raise ValueError('User not found or inactive')
     except Exception as err:
         print(f"Error validating user: {err}")
@@ -40,17 +66,23 @@ def validate_subscription(user_id, subscription_table):
             raise ValueError('User ID cannot be empty')
 
         db_params = get_db_params(subscription_table, user_id)
-        subscription_info = dynamodb.get_item(**db_params).get('Item')
+        subscription_info = dynamodb.get_item(**db_params, **Subscription.projection('message_count_left')).get('Item')
 
         if not subscription_info:
             raise ValueError('Subscription not found')
 
-        if int(subscription_info.get('messageCountLeft', {}).get('N', 0)) <= 0:
+        if Subscription.from_item(subscription_info).message_count_left <= 0:
             raise ValueError('Message count is zero')
     except Exception as err:
         print(f"Error validating subscription: {err}")
         raise ValueError('Failed to validate subscription')
 
+def validate_session(claims):
+    # The quota snapshot taken at login stands in for the subscription read
+    if int(claims.get('q', {}).get('messageCountLeft', 0)) <= 0:
+        print("Error validating subscription: Message count is zero")
+        raise ValueError('Failed to validate subscription')
+
 def validate_public_url(public_url):
     if not public_url or public_url.strip() == '':
         raise ValueError('Public URL cannot be empty')
@@ -66,9 +98,10 @@ def update_whatsapp_link_time(engine_table, user_id, instance_id):
                 'userId': {'S': user_id},
                 'instanceId': {'S': instance_id}
             },
-            'UpdateExpression': 'SET whatsappLinkTime = :whatsappLinkTime',
+            'UpdateExpression': 'SET whatsappLinkTime = :whatsappLinkTime, engineState = :linked, stateChangedTime = :whatsappLinkTime',
             'ExpressionAttributeValues': {
                 ':whatsappLinkTime': {'N': str(int(datetime.now().timestamp()))},
+                ':linked': {'S': LINKED},
                 ':isActive': {'BOOL': True}
             },
             'ConditionExpression': 'isActive = :isActive'
@@ -80,90 +113,313 @@ def update_whatsapp_link_time(engine_table, user_id, instance_id):
         print(f"Error updating Whatsapp link time: {err}")
         raise ValueError('Failed to update Whatsapp link time')
 
-def create_instance(user_id, engine_table):
+def get_active_instance_id(user_id, user_table):
+    """Resolve the user's current engine from the pointer kept on their user row"""
+    if not user_id:
+        raise ValueError('User ID cannot be empty')
+
+    db_params = get_db_params(user_table, user_id)
+    user_info = dynamodb.get_item(**db_params, **User.projection('active_instance_id', 'engine_pointer_checked')).get('Item', {})
+    user = User.from_item(user_info)
+    if user.active_instance_id or user.engine_pointer_checked:
+        return user.active_instance_id
+    # Engines from before the pointer existed are found once and pointed to
+    return backfill_active_instance_id(user_id, user_table, os.environ.get('ENGINE_INSTANCE_TABLE'))
+
+def launch_engine(user_id):
+    if os.environ.get('STAGE') == 'offline':
+        return {'instanceId': "offline_987654322"}
+    if is_shared_mode():
+        # Session container on a multi-tenant host; usually no EC2 launch
+        launch = assign_session(user_id)
+        launch['instanceId'] = f"{launch['hostId']}:{launch['hostPort']}"
+        return launch
+    # Falls back across subnets/instance types on capacity errors
+    return launch_engine_instance(user_id)
+
+def discard_launch(launch):
+    """Undo a launch that lost its lease, so it does not linger unreferenced"""
+    try:
+        if launch.get('hostId'):
+            release_session(launch['hostId'], launch['hostPort'])
+        elif os.environ.get('STAGE') != 'offline':
+            terminate_aws_ec2_instance(launch['instanceId'])
+    except Exception as err:
+        print(f"Error discarding launch {launch.get('instanceId')}: {err}")
+
+def is_engine_live(user_id, instance_id, engine_table):
+    """Whether the engine row is active and not on its way down"""
+    item = dynamodb.get_item(
+        TableName=engine_table,
+        Key={
+            'userId': {'S': user_id},
+            'instanceId': {'S': instance_id}
+        },
+        **EngineInstance.projection('is_active', 'engine_state')
+    ).get('Item')
+    if not item:
+        return False
+    engine = EngineInstance.from_item(item)
+    return bool(engine.is_active) and engine.engine_state not in (DRAINING, TERMINATED)
+
+def create_instance(user_id, engine_table, user_table, deadline):
     try:
-        instance_id = None
         print(f"Creating instance for {user_id}")
 
-        if os.environ.get('STAGE') == 'offline':
-            instance_id = "offline_987654322"
-        else:
-            instance_id = create_aws_ec2_instance(user_id)
-
+        # One engine per user: a live engine is handed back, a dead pointer is cleared
+        active_instance_id = get_active_instance_id(user_id, user_table)
+        if active_instance_id:
+            if is_engine_live(user_id, active_instance_id, engine_table):
+                print(f"User already has active engine {active_instance_id}")
+                return active_instance_id
+            clear_active_engine(user_table, user_id, active_instance_id)
+
+        # Concurrent creates for one user coalesce onto a single launch
+        lease_id = None
+        for _ in range(MAX_LEASE_ATTEMPTS):
+            lease_id = acquire_launch_lease(user_table, user_id)
+            if lease_id:
+                break
+            instance_id = wait_for_launch(user_table, user_id, deadline)
+            if instance_id:
+                print(f"Joined in-flight launch of {instance_id}")
+                return instance_id
+        if not lease_id:
+            raise ValueError('Could not acquire the engine launch lease')
+
+        try:
+            launch = launch_engine(user_id)
+        except Exception:
+            release_launch_lease(user_table, user_id, lease_id)
+            raise
+
+        instance_id = launch.get('instanceId')
         if not instance_id:
+            release_launch_lease(user_table, user_id, lease_id)
             raise ValueError('Failed to create EC2 instance')
 
         print(f"Instance created with ID: {instance_id}")
         now_time = int(datetime.now().timestamp())
-        db_params = {
-            'TableName': engine_table,
-            'Item': {
-                'userId': {'S': user_id},
-                'instanceId': {'S': instance_id},
-                'createdTime': {'N': str(now_time)},
-                'isActive': {'BOOL': True}
-            }
-        }
-
-        dynamodb.put_item(**db_params)
+        # The engine row and the user's active-engine pointer are written together
+        # so "the current engine" is always a single key lookup on the user row.
+        try:
+            dynamodb.transact_write_items(TransactItems=[
+                {
+                    'Put': {
+                        'TableName': engine_table,
+                        'Item': EngineInstance(
+                            user_id=user_id,
+                            instance_id=instance_id,
+                            created_time=now_time,
+                            is_active=True,
+                            subnet_id=launch.get('subnetId'),
+                            instance_type=launch.get('instanceType'),
+                            availability_zone=launch.get('availabilityZone'),
+                            host_id=launch.get('hostId'),
+                            host_port=launch.get('hostPort'),
+                            container_started=launch.get('containerStarted'),
+                            engine_state=LAUNCHING,
+                            state_changed_time=now_time
+                        ).to_item(),
+                        'ConditionExpression': 'attribute_not_exists(instanceId)'
+                    }
+                },
+                complete_launch_lease(user_table, user_id, lease_id, instance_id, now_time)
+            ])
+        except Exception:
+            # Lease lost (or the write failed): nobody will ever reference this engine
+            discard_launch(launch)
+            release_launch_lease(user_table, user_id, lease_id)
+            raise
         print('createInstance saved in DB')
         return instance_id
+    except RequestInProgress:
+        raise
     except Exception as err:
         print(f"Error creating instance: {err}")
         raise ValueError('Failed to create instance')
 
-def status_instance(user_id, instance_id):
+def get_engine(user_id, instance_id, engine_table):
+    if not user_id or not instance_id:
+        raise ValueError('User ID and Instance ID cannot be empty')
+
+    item = dynamodb.get_item(
+        TableName=engine_table,
+        Key={
+            'userId': {'S': user_id},
+            'instanceId': {'S': instance_id}
+        }
+    ).get('Item')
+    if not item:
+        raise ValueError('Instance not found')
+    return EngineInstance.from_item(item)
+
+def locate_session(engine, engine_table):
+    """Endpoint of a session container on a multi-tenant host, None while it is starting"""
+    if not engine.container_started:
+        if not ensure_session_container(engine.host_id, engine.host_port):
+            return None
+        dynamodb.update_item(
+            TableName=engine_table,
+            Key=engine.key(),
+            UpdateExpression='SET containerStarted = :started',
+            ExpressionAttributeValues={':started': {'BOOL': True}}
+        )
+
+    return get_session_endpoint(engine.host_id, engine.host_port)
+
+def locate_instance(user_id, instance_id):
+    """Public IP of a dedicated engine, None until it is running with an address"""
+    params = {
+        'Filters': [
+            {'Name': 'instance-state-name', 'Values': ['running']},
+            {'Name': 'tag:UserId', 'Values': [user_id]}
+        ],
+        'InstanceIds': [instance_id]
+    }
+    data = call_describe_instances(params)
+    if not data or not data.get('Reservations'):
+        return None
+    return data['Reservations'][0]['Instances'][0].get('PublicIpAddress')
+
+def advance_engine_state(engine, engine_table, new_state, public_url=None):
+    """Persist a state transition; a concurrent poller that got there first wins"""
+    now_time = str(int(datetime.now().timestamp()))
+    update_params = {
+        'TableName': engine_table,
+        'Key': engine.key(),
+        'UpdateExpression': 'SET engineState = :newState, stateChangedTime = :now, probeCount = :zero',
+        'ConditionExpression': 'attribute_not_exists(engineState) OR engineState = :oldState',
+        'ExpressionAttributeValues': {
+            ':newState': {'S': new_state},
+            ':oldState': {'S': engine.engine_state or LAUNCHING},
+            ':now': {'N': now_time},
+            ':zero': {'N': '0'}
+        }
+    }
+    if public_url:
+        update_params['UpdateExpression'] += ', publicUrl = :publicUrl'
+        update_params['ExpressionAttributeValues'][':publicUrl'] = {'S': public_url}
+    try:
+        dynamodb.update_item(**update_params)
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        # Someone else moved the engine on; report what they stored, not our target
+        print(f"Engine {engine.instance_id} already left state {engine.engine_state}")
+        current = dynamodb.get_item(
+            TableName=engine_table,
+            Key=engine.key(),
+            ConsistentRead=True,
+            **EngineInstance.projection('engine_state', 'probe_count', 'public_url', 'is_active')
+        ).get('Item') or {}
+        stored = EngineInstance.from_item(current)
+        engine.engine_state = stored.engine_state
+        engine.probe_count = stored.probe_count
+        engine.public_url = stored.public_url
+        engine.is_active = stored.is_active
+        return
+    engine.engine_state = new_state
+    engine.probe_count = 0
+    if public_url:
+        engine.public_url = public_url
+
+def record_probe(engine, engine_table):
+    dynamodb.update_item(
+        TableName=engine_table,
+        Key=engine.key(),
+        UpdateExpression='ADD probeCount :one',
+        ExpressionAttributeValues={':one': {'N': '1'}}
+    )
+    engine.probe_count = (engine.probe_count or 0) + 1
+
+def status_instance(user_id, instance_id, engine_table, deadline):
+    """Advance the engine through launching -> booting -> ready and report where it is.
+
+    Returns {'publicUrl', 'engineState', 'retryAfterMs'}; publicUrl is only
+    set once the engine answers its health check.
+    """
     try:
         if os.environ.get('STAGE') == 'offline':
-            return "localhost:3001"
-
-        params = {
-            'Filters': [
-                {'Name': 'instance-state-name', 'Values': ['running']},
-                {'Name': 'tag:UserId', 'Values': [user_id]}
-            ],
-            'InstanceIds': [instance_id]
+            return {'publicUrl': "localhost:3001", 'engineState': READY, 'retryAfterMs': 0}
+
+        engine = get_engine(user_id, instance_id, engine_table)
+        state = engine.engine_state or LAUNCHING
+
+        if state in (DRAINING, TERMINATED) or not engine.is_active:
+            raise ValueError('Instance is shutting down')
+
+        if state == LAUNCHING:
+            if engine.host_id:
+                public_url = locate_session(engine, engine_table)
+            else:
+                public_url = locate_instance(user_id, instance_id)
+            if public_url:
+                advance_engine_state(engine, engine_table, BOOTING, public_url)
+
+        if engine.engine_state == BOOTING:
+            if probe_engine_health(engine.public_url, deadline.timeout(HEALTH_PROBE_TIMEOUT_SECONDS)):
+                advance_engine_state(engine, engine_table, READY)
+
+        state = engine.engine_state or LAUNCHING
+        if state in (DRAINING, TERMINATED) or not engine.is_active:
+            raise ValueError('Instance is shutting down')
+        if state not in SERVING_STATES:
+            record_probe(engine, engine_table)
+
+        return {
+            'publicUrl': engine.public_url if state in SERVING_STATES else None,
+            'engineState': state,
+            'retryAfterMs': retry_after_ms(state, engine.probe_count)
         }
-        data = call_describe_instances(params)
-        instance = data['Reservations'][0]['Instances'][0]
-        public_url = instance.get('PublicIpAddress')
-        if not public_url:
-            raise ValueError('Public URL not found')
-        return public_url
     except Exception as err:
         print(f"Error getting instance status: {err}")
         raise ValueError('Failed to get instance status')
 
-def get_message_qr_code(public_url):
+def get_message_qr_code(public_url, deadline):
     try:
         validate_public_url(public_url)
-        response = requests.get(f"http://{public_url}/qrCode")
+        response = engine_request('GET', public_url, '/qrCode', deadline)
         response.raise_for_status()
         return response.json().get('qrCode')
+    except EngineNotReady:
+        raise
+    except (requests.ConnectionError, requests.Timeout) as err:
+        print(f"Engine not answering for QR code: {err}")
+        raise EngineNotReady(BOOTING, retry_after_ms(BOOTING))
     except Exception as err:
         print(f"Error getting QR code: {err}")
         raise ValueError('Failed to get QR code')
 
-def login_status(public_url, engine_table, user_id, instance_id):
+def login_status(public_url, engine_table, user_id, instance_id, deadline):
     try:
         validate_public_url(public_url)
-        response = requests.get(f"http://{public_url}/loginStatus")
+        response = engine_request('GET', public_url, '/loginStatus', deadline)
         response.raise_for_status()
 
         if response.json().get('loginStatus'):
             update_whatsapp_link_time(engine_table, user_id, instance_id)
         return response.json().get('loginStatus')
+    except EngineNotReady:
+        raise
+    except (requests.ConnectionError, requests.Timeout) as err:
+        print(f"Engine not answering for login status: {err}")
+        raise EngineNotReady(BOOTING, retry_after_ms(BOOTING))
     except Exception as err:
         print(f"Error getting login status: {err}")
         raise ValueError('Failed to get login status')
 
-def log_out_and_terminate_instances(public_url, user_id, instance_id, event_table):
+def log_out_and_terminate_instances(public_url, user_id, instance_id, user_table, engine_table, deadline):
     try:
         validate_public_url(public_url)
-        log_out_message = requests.get(f"http://{public_url}/logout")
-        log_out_message.raise_for_status()
-        terminate_instance(user_id, instance_id, event_table)
-        return log_out_message.json().get('loginStatus')
+        try:
+            # Short cap: a dead engine must not keep the user from terminating it
+            log_out_message = engine_request('GET', public_url, '/logout', deadline, cap=3.0)
+            log_out_message.raise_for_status()
+            login_state = log_out_message.json().get('loginStatus')
+        except (EngineNotReady, requests.RequestException) as err:
+            print(f"Engine logout skipped, terminating anyway: {err}")
+            login_state = False
+        terminate_instance(user_id, instance_id, user_table, engine_table)
+        return login_state
     except Exception as err:
         print(f"Error logging out and terminating instances: {err}")
         raise ValueError('Failed to log out and terminate instances')
@@ -179,7 +435,11 @@ def create_event(user_id, instance_id, event_table, **request_params):
         description = request_params.get('description', 'No Description')
         editorValue = request_params.get('editorValue', '')
         senderInfo = request_params.get('senderInfo', {})
-        if senderInfo:
+        contact_list = None
+        if request_params.get('contactList'):
+            # Stored list: the event keeps only the immutable version reference
+            contact_list = resolve_contact_list(user_id, request_params['contactList'])
+        elif senderInfo:
             s3 = boto3.client('s3')
             bucket_name = os.environ.get('SENDER_INFO_BUCKET')
             if not bucket_name:
@@ -206,8 +466,13 @@ def create_event(user_id, instance_id, event_table, **request_params):
                 'isCompleted': {'BOOL': False},
             }
         }
+        if contact_list:
+            db_params['Item']['contactList'] = {'S': contact_list.list_ref}
+            db_params['Item']['recipientCount'] = {'N': str(contact_list.contact_count)}
         dynamodb.put_item(**db_params)
         print('Event created successfully')
+        if contact_list:
+            return {'eventId': eventId, 'contactList': contact_list.list_ref}
         return {'eventId': eventId}
     except Exception as err:
         print(f"Error creating event: {err}")
@@ -236,52 +501,159 @@ def update_event(user_id, instance_id, event_id):
         print(f"Error updating broadcast: {err}")
         raise ValueError('Failed to update broadcast')
 
-def send_message(public_url, message):
+def deliver_message(public_url, message, deadline, lane=INTERACTIVE):
+    """Send one message through the engine; engine and HTTP errors are raised as-is"""
+    if not message:
+        raise ValueError('No message to send')
+
+    validate_public_url(public_url)
+    # Attachments travel as a sha256 + URL the engine fetches and caches once
+    message = resolve_media_reference(message)
+    # Queue behind the engine's priority lanes so a one-off message is not
+    # stuck behind a running broadcast
+    lease_id = acquire_slot(public_url, lane, deadline)
     try:
-        if not message:
-            raise ValueError('No message to send')
-
-        validate_public_url(public_url)
-        response = requests.post(f"http://{public_url}/sendMessage", json=message)
-        response.raise_for_status()
-        return response.json()
+        response = engine_request('POST', public_url, '/sendMessage', deadline, json=message)
+    finally:
+        release_slot(public_url, lease_id)
+    response.raise_for_status()
+    return response.json()
+
+def get_event_instance_id(user_id, event_id, event_table):
+    """Engine a broadcast was started on"""
+    item = dynamodb.get_item(
+        TableName=event_table,
+        Key={'userId': {'S': user_id}, 'eventId': {'S': event_id}},
+        **Event.projection('instance_id')
+    ).get('Item')
+    return Event.from_item(item).instance_id if item else None
+
+def resolve_retry_endpoint(user_id, instance_id):
+    """Current endpoint of an engine that is still serving, else None"""
+    item = dynamodb.get_item(
+        TableName=os.environ.get('ENGINE_INSTANCE_TABLE'),
+        Key={'userId': {'S': user_id}, 'instanceId': {'S': instance_id}},
+        ConsistentRead=True,
+        **EngineInstance.projection('is_active', 'engine_state', 'public_url')
+    ).get('Item')
+    if not item:
+        return None
+    engine = EngineInstance.from_item(item)
+    if not engine.is_active or engine.engine_state not in SERVING_STATES or not engine.public_url:
+        return None
+    return engine.public_url
+
+def send_message(public_url, message, deadline, lane=INTERACTIVE, user_id=None, event_id=None, recipient=None,
+                 instance_id=None):
+    try:
+        # Inline media goes to S3 up front, so a queued retry only stores its hash
+        message = store_media_reference(message)
+        result = deliver_message(public_url, message, deadline, lane)
     except Exception as err:
+        if event_id and recipient and classify_error(err):
+            # Campaign sends are retried server-side instead of failing the client
+            print(f"Send to {recipient} for {event_id} failed, handing it to the retry queue: {err}")
+            event_table = os.environ.get('EVENT_TABLE')
+            # The retry names the engine, not its address, which may be reassigned
+            instance_id = instance_id or get_event_instance_id(user_id, event_id, event_table)
+            return enqueue_failed_send(
+                event_table, os.environ.get('DELIVERY_LEDGER_TABLE'),
+                user_id, event_id, recipient, instance_id, message, lane, err
+            )
+        if isinstance(err, EngineNotReady):
+            raise
         print(f"Error sending message: {err}")
         raise ValueError('Failed to send message')
+    if event_id and recipient:
+        record_sent(os.environ.get('DELIVERY_LEDGER_TABLE'), user_id, event_id, recipient)
+    return result
+
+def drain_send_retries(deadline):
+    try:
+        return drain_retries(
+            deliver_message, resolve_retry_endpoint,
+            os.environ.get('EVENT_TABLE'), os.environ.get('DELIVERY_LEDGER_TABLE'), deadline
+        )
+    except Exception as err:
+        print(f"Error draining send retries: {err}")
+        raise ValueError('Failed to drain send retries')
+
+def get_lane_stats(public_url):
+    validate_public_url(public_url)
+    return lane_stats(public_url)
+
+def upload_media(**request_params):
+    try:
+        if request_params.get('data'):
+            sha256 = store_inline_media(request_params['data'], request_params.get('contentType'))
+            return {'sha256': sha256, 'exists': True}
+        return prepare_media_upload(
+            request_params.get('sha256'),
+            request_params.get('contentType'),
+            request_params.get('size')
+        )
+    except ValueError:
+        raise
+    except Exception as err:
+        print(f"Error preparing media upload: {err}")
+        raise ValueError('Failed to prepare media upload')
 
-def terminate_instance(user_id, instance_id, event_table):
+def terminate_instance(user_id, instance_id, user_table, engine_table):
     try:
-        user_instance_id = instance_id
+        user_instance_id = instance_id or get_active_instance_id(user_id, user_table)
 
         if not user_instance_id:
-            db_params = {
-                'TableName': event_table,
-                'Key': {
-                    'userId': {'S': user_id}
-                },
-                'FilterExpression': 'isActive = :isActive',
-                'ExpressionAttributeValues': {
-                    ':isActive': {'BOOL': True}
-                },
-                'Limit': 1
-            }
-            user_instance_id = dynamodb.query(**db_params)['Items'][0]['eventId']['S']
+            raise ValueError('No active instance found')
 
         if os.environ.get('STAGE') != 'offline':
-            terminate_aws_ec2_instance(user_instance_id)
-
-        terminate_db_params = {
-            'TableName': event_table,
+            engine = get_engine(user_id, user_instance_id, engine_table)
+            # Status polls stop treating the engine as usable while it goes down
+            advance_engine_state(engine, engine_table, DRAINING)
+            if engine.host_id:
+                # Shared host: free the session slot, the host stays up for others
+                release_session(engine.host_id, engine.host_port)
+            else:
+                terminate_aws_ec2_instance(user_instance_id)
+
+        now_time = str(int(datetime.now().timestamp()))
+        deactivate_engine = {
+            'TableName': engine_table,
             'Key': {
                 'userId': {'S': user_id},
-                'eventId': {'S': user_instance_id}
+                'instanceId': {'S': user_instance_id}
             },
-            'UpdateExpression': 'SET terminatedTime = :terminatedTime',
+            'UpdateExpression': 'SET isActive = :isActive, terminatedTime = :terminatedTime, engineState = :terminated',
             'ExpressionAttributeValues': {
-                ':terminatedTime': {'N': str(int(datetime.now().timestamp()))}
+                ':isActive': {'BOOL': False},
+                ':terminatedTime': {'N': now_time},
+                ':terminated': {'S': TERMINATED}
             }
         }
-        dynamodb.update_item(**terminate_db_params)
+        # Deactivate the engine row and clear the pointer in one transaction. The
+        # pointer is only removed if it still refers to this engine, so terminating
+        # an old engine never detaches a newer one.
+        try:
+            dynamodb.transact_write_items(TransactItems=[
+                {'Update': deactivate_engine},
+                {
+                    'Update': {
+                        'TableName': user_table,
+                        'Key': {'userId': {'S': user_id}},
+                        'UpdateExpression': (
+                            'REMOVE activeInstanceId, engineLeaseId, engineLeaseExpiresAt, engineLeaseInstanceId '
+                            'SET modifiedTime = :modifiedTime'
+                        ),
+                        'ConditionExpression': 'activeInstanceId = :instanceId',
+                        'ExpressionAttributeValues': {
+                            ':instanceId': {'S': user_instance_id},
+                            ':modifiedTime': {'N': now_time}
+                        }
+                    }
+                }
+            ])
+        except dynamodb.exceptions.TransactionCanceledException:
+            print(f"Active engine pointer does not reference {user_instance_id}, leaving it untouched")
+            dynamodb.update_item(**deactivate_engine)
         return user_instance_id
     except Exception as err:
         print(f"Error terminating instance: {err}")
@@ -289,16 +661,10 @@ def terminate_instance(user_id, instance_id, event_table):
 
 def lambda_handler(event, context):
     try:
-        print("Received event:", json.dumps(event, indent=2))
-        
-        body = {}
-        if 'body' in event:
-            body_temp = event['body']
-            if isinstance(body_temp, str):
-                try:
-                    body = json.loads(body_temp)
-                except json.JSONDecodeError:
-                    pass
+        # The body can be a multi-megabyte (compressed) recipient list; log everything else
+        print("Received event:", json.dumps({name: value for name, value in redact_event(event).items() if name != 'body'}, indent=2))
+
+        body = parse_body(event)
         user_id = body.get('userId')
         instance_id = body.get('instanceId')
         public_url = body.get('publicUrl')
@@ -306,6 +672,9 @@ def lambda_handler(event, context):
         message = body.get('message')
         event_id = body.get('eventId')
 
+        if message is not None and not isinstance(message, dict):
+            raise ValueError('message must be a JSON object')
+
         user_table = os.environ.get('USER_TABLE')
         event_table = os.environ.get('EVENT_TABLE')
         engine_table = os.environ.get('ENGINE_INSTANCE_TABLE')
@@ -314,43 +683,120 @@ def lambda_handler(event, context):
         if not action:
             raise ValueError('Action cannot be empty')
 
-        if action != "message":
-            validate_user(user_id, user_table)
-            validate_subscription(user_id, user_subscription)
+        # Every outbound engine call is budgeted against the invocation's remaining time
+        deadline = Deadline(context)
+
+        # Mutating actions accept an optional idempotency key so client retries
+        # replay the first response instead of repeating the work
+        idempotency_key = get_idempotency_key(event, body)
+        request_hash = request_fingerprint(body) if idempotency_key else None
+
+        if action == "receipts":
+            # Posted by engines, not users: authenticated by the body signature
+            verify_signature(event)
+        elif action != "message":
+            token = get_token_from_event(event, body)
+            if token:
+                # Signed session from login: verified locally, no DynamoDB read
+                claims = verify_token(token)
+                user_id = claims['sub']
+                validate_session(claims)
+            else:
+                validate_user(user_id, user_table)
+                validate_subscription(user_id, user_subscription)
+
+        if not instance_id and action in ENGINE_ACTIONS:
+            instance_id = get_active_instance_id(user_id, user_table)
 
         action_map = {
             "create": lambda: {
-                'body': json.dumps({'instanceId': create_instance(user_id, engine_table),'statusCode': 200})
+                'body': json.dumps({'instanceId': create_instance(user_id, engine_table, user_table, deadline),'statusCode': 200})
             },
             "status": lambda: {
-                'body': json.dumps({'publicUrl': status_instance(user_id, instance_id),'statusCode': 201})
+                'body': json.dumps({**status_instance(user_id, instance_id, engine_table, deadline),'statusCode': 201})
             },
             "qrcode": lambda: {
-                'body': json.dumps({'qrCode': get_message_qr_code(public_url),'statusCode': 202})
+                'body': json.dumps({'qrCode': get_message_qr_code(public_url, deadline),'statusCode': 202})
             },
             "loginStatus": lambda: {
-                'body': json.dumps({'loginStatus': login_status(public_url, engine_table, user_id, instance_id),'statusCode': 203})
+                'body': json.dumps({'loginStatus': login_status(public_url, engine_table, user_id, instance_id, deadline),'statusCode': 203})
             },
             "startBroadCast": lambda: {
-                'body': json.dumps({'createEvent': create_event(user_id, instance_id, event_table, **body),'statusCode': 204})
+                'body': json.dumps({'createEvent': run_idempotent(
+                    f"{user_id}#startBroadCast", idempotency_key, request_hash,
+                    lambda: create_event(user_id, instance_id, event_table, **body)
+                ),'statusCode': 204})
             },
             "sendMessage": lambda: {
-                'body': json.dumps({'messageResponse': send_message(public_url, message),'statusCode': 205})
+                'body': json.dumps({'messageResponse': run_idempotent(
+                    f"{user_id}#sendMessage", idempotency_key, request_hash,
+                    lambda: send_message(
+                        public_url, message, deadline, lane_for(body),
+                        user_id=user_id, event_id=event_id,
+                        recipient=body.get('recipient') or (message or {}).get('phone'),
+                        instance_id=instance_id
+                    )
+                ),'statusCode': 205})
+            },
+            "laneStats": lambda: {
+                'body': json.dumps({'laneStats': get_lane_stats(public_url),'statusCode': 213})
+            },
+            "uploadMedia": lambda: {
+                'body': json.dumps({'media': upload_media(**body),'statusCode': 209})
+            },
+            "saveContactList": lambda: {
+                'body': json.dumps({'contactList': run_idempotent(
+                    f"{user_id}#saveContactList", idempotency_key, request_hash,
+                    lambda: save_contact_list(
+                        user_id,
+                        list_id=body.get('listId'),
+                        name=body.get('name'),
+                        contacts=body.get('contacts'),
+                        delta=body.get('delta'),
+                        base_version=body.get('baseVersion')
+                    )
+                ),'statusCode': 210})
+            },
+            "getContactList": lambda: {
+                'body': json.dumps({'contactList': get_contact_list(user_id, body.get('contactList') or body.get('listId')),'statusCode': 211})
+            },
+            "receipts": lambda: {
+                'body': json.dumps({'receipts': ingest_receipts(event_table, body.get('receipts'), user_id),'statusCode': 212})
+            },
+            "exportBroadCast": lambda: {
+                'body': json.dumps({'export': export_event_results(
+                    user_id, event_id, event_table, deadline, body.get('format', 'csv')
+                ),'statusCode': 214})
             },
             "updateBroadCast": lambda: {
                 'body': json.dumps({'updateEvent': update_event(user_id, instance_id, event_id),'statusCode': 206})
             },
             "logout": lambda: {
-                'body': json.dumps({'logOutandTerminateResponse': log_out_and_terminate_instances(public_url, user_id, instance_id, event_table),'statusCode': 207})
+                'body': json.dumps({'logOutandTerminateResponse': log_out_and_terminate_instances(public_url, user_id, instance_id, user_table, engine_table, deadline),'statusCode': 207})
             },
             "terminate": lambda: {
-                'body': json.dumps({'instanceId': terminate_instance(user_id, instance_id, event_table),'statusCode': 208})
+                'body': json.dumps({'instanceId': terminate_instance(user_id, instance_id, user_table, engine_table),'statusCode': 208})
             },
         }
 
         return action_map.get(action, lambda: {
             'body': json.dumps({'message': 'Invalid action','statusCode': 400})
         })()
+    except RequestInProgress as err:
+        print(f"Duplicate request in progress: {err}")
+        return {
+            'body': json.dumps({'message': str(err), 'retryAfterMs': err.retry_after_ms, 'statusCode': 409})
+        }
+    except EngineNotReady as err:
+        print(f"Engine not ready: {err}")
+        return {
+            'body': json.dumps({
+                'message': str(err),
+                'engineState': err.engine_state,
+                'retryAfterMs': err.retry_after_ms,
+                'statusCode': 503
+            })
+        }
     except ValueError as err:
         print(f"Validation error: {err}")
         return {
@@ -361,3 +807,13 @@ def lambda_handler(event, context):
         return {
             'body': json.dumps({'message': 'SYSTEM ERROR','statusCode': 500})
         }
+
+def retry_handler(event, context):
+    """Scheduled entry point: retries due campaign sends until the invocation runs short"""
+    try:
+        summary = drain_send_retries(Deadline(context))
+        print(f"Send retries drained: {json.dumps(summary)}")
+        return summary
+    except Exception as err:
+        print(f"System error: {err}")
+        raise
@@ -0,0 +1,310 @@
+"""Delivery and read receipts posted by engines.
+
+Engines post receipts in batches. A batch is validated and coalesced in
+memory per event (only the furthest status per recipient survives) before
+anything is written, then compared with the ledger in BatchGetItem pages.
+Each chunk of advanced rows is committed in one TransactWriteItems call and
+its counter deltas are then added to the event with a single UpdateItem, so
+a campaign's receipts cost a handful of requests instead of one write per
+receipt.
+
+Statuses only move forward (sent -> delivered -> read, or sent -> failed),
+which makes duplicates and out-of-order receipts no-ops: a receipt that does
+not advance the ledger changes neither the row nor the counters. Every row
+write is conditioned on the status it was advanced from, and counters are
+only added for rows whose write committed, so a batch redelivered after a
+failure or a timeout only counts what did not commit the first time, and a
+concurrent writer makes the chunk re-read instead of double counting. The
+event item stays out of the transaction: concurrent ingests and dead-letter
+updates of the same campaign then never cancel each other's chunks.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+import boto3
+
+from bmdata import LedgerEntry
+
+dynamodb = boto3.client('dynamodb')
+
+SIGNATURE_HEADER = 'x-receipt-signature'
+MAX_RECEIPTS_PER_REQUEST = 10000
+BATCH_GET_SIZE = 100
+# TransactWriteItems takes 100 items
+TRANSACT_SIZE = 100
+MAX_BATCH_ATTEMPTS = 5
+
+SENT = 'sent'
+DELIVERED = 'delivered'
+READ = 'read'
+FAILED = 'failed'
+
+# Receipts never move a recipient to a lower rank. A delivery report beats a
+# failure because the engine can only see it if the message arrived.
+STATUS_RANK = {SENT: 1, FAILED: 2, DELIVERED: 3, READ: 4}
+# Event counters a recipient contributes to once it reaches a status
+STATUS_COUNTERS = {
+    SENT: (),
+    FAILED: ('failureCount',),
+    DELIVERED: ('deliveredCount',),
+    READ: ('deliveredCount', 'readCount'),
+}
+STATUS_TIME_SLOT = {
+    SENT: 'sent_time',
+    DELIVERED: 'delivered_time',
+    READ: 'read_time',
+    FAILED: 'failed_time',
+}
+
+
+def _ledger_table():
+    table = os.environ.get('DELIVERY_LEDGER_TABLE')
+    if not table:
+        raise ValueError('DELIVERY_LEDGER_TABLE environment variable is not set')
+    return table
+
+
+def _secret():
+    secret = os.environ.get('RECEIPT_WEBHOOK_SECRET')
+    if not secret:
+        raise ValueError('RECEIPT_WEBHOOK_SECRET environment variable is not set')
+    return secret.encode('utf-8')
+
+
+def verify_signature(event):
+    """Check the engine's HMAC-SHA256 of the request body exactly as it was sent"""
+    headers = event.get('headers') or {}
+    signature = headers.get(SIGNATURE_HEADER) or headers.get(SIGNATURE_HEADER.title()) or ''
+    if signature.startswith('sha256='):
+        signature = signature[len('sha256='):]
+
+    body = event.get('body') or ''
+    raw = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode('utf-8')
+    expected = hmac.new(_secret(), raw, hashlib.sha256).hexdigest()
+    # compare_digest only takes ASCII strings; anything else is not a hex digest anyway
+    if not signature.isascii() or not hmac.compare_digest(signature, expected):
+        raise ValueError('Invalid receipt signature')
+
+
+def record_sent(table, user_id, event_id, recipient):
+    """Ledger row for a campaign send the engine accepted; never raises.
+
+    Written only if no row exists yet, so a receipt that already arrived is
+    never moved back, and the export lists recipients whose engine posts no
+    receipts. The send itself already succeeded, so a failed write is logged
+    rather than turned into an error the client would retry.
+    """
+    now = int(time.time())
+    row = LedgerEntry(
+        event_id=event_id, recipient=str(recipient), user_id=user_id,
+        status=SENT, sent_time=now, updated_time=now
+    )
+    try:
+        dynamodb.put_item(
+            TableName=table,
+            Item=row.to_item(),
+            ConditionExpression='attribute_not_exists(recipient)'
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        pass
+    except Exception as err:
+        print(f"Error recording sent ledger row for {event_id}: {err}")
+
+
+def coalesce(receipts, default_user_id=None):
+    """Group receipts by (userId, eventId), keeping the furthest status per recipient"""
+    grouped = {}
+    rejected = 0
+    for receipt in receipts:
+        if not isinstance(receipt, dict):
+            rejected += 1
+            continue
+        status = receipt.get('status')
+        user_id = receipt.get('userId') or default_user_id
+        if status not in STATUS_RANK or not user_id or not receipt.get('eventId') or not receipt.get('recipient'):
+            rejected += 1
+            continue
+        timestamp = receipt.get('timestamp')
+        if timestamp is not None:
+            try:
+                receipt = dict(receipt, timestamp=int(timestamp))
+            except (TypeError, ValueError):
+                rejected += 1
+                continue
+        recipients = grouped.setdefault((user_id, receipt['eventId']), {})
+        recipient = str(receipt['recipient'])
+        current = recipients.get(recipient)
+        if current is None or STATUS_RANK[status] > STATUS_RANK[current['status']]:
+            recipients[recipient] = receipt
+    return grouped, rejected
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _batch_get(table, event_id, recipients):
+    """Current ledger rows for recipients, retrying unprocessed keys"""
+    rows = {}
+    for chunk in _chunks(recipients, BATCH_GET_SIZE):
+        request = {table: {
+            'Keys': [{'eventId': {'S': event_id}, 'recipient': {'S': recipient}} for recipient in chunk],
+            'ConsistentRead': True,
+        }}
+        for attempt in range(MAX_BATCH_ATTEMPTS):
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(table, []):
+                row = LedgerEntry.from_item(item)
+                rows[row.recipient] = row
+            request = response.get('UnprocessedKeys') or {}
+            if not request:
+                break
+            time.sleep(0.05 * 2 ** attempt)
+        else:
+            raise RuntimeError('Ledger read was throttled')
+    return rows
+
+
+def advance(row, receipt, now):
+    """Apply a receipt to a ledger row; returns the counter deltas, or None if stale"""
+    status = receipt['status']
+    old_status = row.status if row.updated_time else None
+    if old_status and STATUS_RANK[status] <= STATUS_RANK[old_status]:
+        return None
+
+    deltas = {}
+    for counter in STATUS_COUNTERS.get(old_status, ()):
+        deltas[counter] = deltas.get(counter, 0) - 1
+    for counter in STATUS_COUNTERS[status]:
+        deltas[counter] = deltas.get(counter, 0) + 1
+
+    row.status = status
+    row.updated_time = now
+    setattr(row, STATUS_TIME_SLOT[status], int(receipt.get('timestamp') or now))
+    if receipt.get('messageId'):
+        row.message_id = receipt['messageId']
+    if status == FAILED and receipt.get('errorCode'):
+        row.error_code = str(receipt['errorCode'])
+    return {counter: delta for counter, delta in deltas.items() if delta}
+
+
+def _add_counters(event_table, user_id, event_id, totals):
+    """ADD counter deltas to the event; False if the event does not exist"""
+    try:
+        dynamodb.update_item(
+            TableName=event_table,
+            Key={'userId': {'S': user_id}, 'eventId': {'S': event_id}},
+            UpdateExpression='ADD ' + ', '.join(f"#c{index} :c{index}" for index in range(len(totals))),
+            ConditionExpression='attribute_exists(eventId)',
+            ExpressionAttributeNames={f"#c{index}": counter for index, counter in enumerate(totals)},
+            ExpressionAttributeValues={f":c{index}": {'N': str(delta)} for index, delta in enumerate(totals.values())}
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def _ledger_put(table, row, seen):
+    """Transaction Put of an advanced row, conditioned on the row it was advanced from"""
+    put = {'TableName': table, 'Item': row.to_item()}
+    if seen is None:
+        put['ConditionExpression'] = 'attribute_not_exists(recipient)'
+    elif seen.updated_time:
+        put['ConditionExpression'] = '#status = :seen'
+        put['ExpressionAttributeNames'] = {'#status': 'status'}
+        put['ExpressionAttributeValues'] = {':seen': {'S': seen.status}}
+    else:
+        put['ConditionExpression'] = 'attribute_not_exists(updatedTime)'
+    return {'Put': put}
+
+
+def _commit_chunk(table, event_table, user_id, event_id, latest, now, count):
+    """Apply receipts for up to TRANSACT_SIZE recipients in one transaction.
+
+    Counters move only after the rows committed, by exactly the deltas of
+    those rows. Returns (applied, rejected, counted); counted is False once
+    the event turned out not to exist, in which case only the ledger is
+    written.
+    """
+    for attempt in range(MAX_BATCH_ATTEMPTS):
+        rows = _batch_get(table, event_id, list(latest))
+        writes = []
+        totals = {}
+        rejected = 0
+        for recipient, receipt in latest.items():
+            seen = rows.get(recipient)
+            if seen is not None and seen.user_id != user_id:
+                rejected += 1
+                continue
+            row = LedgerEntry.from_item(seen.to_item()) if seen else LedgerEntry(
+                event_id=event_id, recipient=recipient, user_id=user_id
+            )
+            deltas = advance(row, receipt, now)
+            if deltas is None:
+                continue
+            writes.append(_ledger_put(table, row, seen))
+            for counter, delta in deltas.items():
+                totals[counter] = totals.get(counter, 0) + delta
+
+        if not writes:
+            return 0, rejected, count
+        try:
+            dynamodb.transact_write_items(TransactItems=writes)
+        except dynamodb.exceptions.TransactionCanceledException:
+            # Another writer moved one of the rows, or the transaction conflicted: re-read
+            time.sleep(0.05 * 2 ** attempt)
+            continue
+        totals = {counter: delta for counter, delta in totals.items() if delta}
+        if count and totals and not _add_counters(event_table, user_id, event_id, totals):
+            count = False
+            print(f"Receipts for unknown event {event_id}; ledger updated, counters skipped")
+        return len(writes), rejected, count
+    raise RuntimeError('Ledger update kept conflicting')
+
+
+def ingest_receipts(event_table, receipts, default_user_id=None):
+    """Flush a batch of receipts into the ledger and the events' counters"""
+    try:
+        if not isinstance(receipts, list) or not receipts:
+            raise ValueError('receipts must be a non-empty list')
+        if len(receipts) > MAX_RECEIPTS_PER_REQUEST:
+            raise ValueError(f'At most {MAX_RECEIPTS_PER_REQUEST} receipts per request')
+
+        table = _ledger_table()
+        now = int(time.time())
+        # Every receipt is validated here, before the first write
+        grouped, rejected = coalesce(receipts, default_user_id)
+        applied = 0
+        unknown_events = 0
+
+        for (user_id, event_id), latest in grouped.items():
+            count = True
+            recipients = list(latest)
+            for chunk in _chunks(recipients, TRANSACT_SIZE):
+                chunk_applied, chunk_rejected, count = _commit_chunk(
+                    table, event_table, user_id, event_id,
+                    {recipient: latest[recipient] for recipient in chunk}, now, count
+                )
+                applied += chunk_applied
+                rejected += chunk_rejected
+            if not count:
+                unknown_events += 1
+
+        return {
+            'received': len(receipts),
+            'applied': applied,
+            'ignored': len(receipts) - applied - rejected,
+            'rejected': rejected,
+            'events': len(grouped),
+            'unknownEvents': unknown_events,
+        }
+    except ValueError as err:
+        print(f"Error ingesting receipts: {err}")
+        raise
+    except Exception as err:
+        print(f"Error ingesting receipts: {err}")
+        raise ValueError('Failed to ingest receipts')
@@ -0,0 +1,86 @@
+import base64
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd bodies are rejected when the wheel is not packaged
+    zstandard = None
+
+# Hard limit on the decompressed body; protects the function from zip bombs
+MAX_DECOMPRESSED_BYTES = 64 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _content_encoding(event):
+    headers = event.get('headers') or {}
+    encoding = headers.get('content-encoding') or headers.get('Content-Encoding') or ''
+    return encoding.strip().lower()
+
+
+def _gunzip(raw):
+    """Inflate chunk by chunk so an oversized body is refused before it is fully expanded"""
+    inflater = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    out = bytearray()
+    view = memoryview(raw)
+    try:
+        for start in range(0, len(view), CHUNK_SIZE):
+            out += inflater.decompress(view[start:start + CHUNK_SIZE], MAX_DECOMPRESSED_BYTES + 1 - len(out))
+            if len(out) > MAX_DECOMPRESSED_BYTES or inflater.unconsumed_tail:
+                raise ValueError('Request body is too large once decompressed')
+        out += inflater.flush()
+    except zlib.error as err:
+        raise ValueError(f'Request body is not valid gzip: {err}')
+    if not inflater.eof:
+        raise ValueError('Request body is truncated gzip')
+    if len(out) > MAX_DECOMPRESSED_BYTES:
+        raise ValueError('Request body is too large once decompressed')
+    return out
+
+
+def _unzstd(raw):
+    if zstandard is None:
+        raise ValueError('zstd request bodies are not supported')
+    reader = zstandard.ZstdDecompressor().stream_reader(raw)
+    out = bytearray()
+    while True:
+        try:
+            chunk = reader.read(CHUNK_SIZE)
+        except zstandard.ZstdError as err:
+            raise ValueError(f'Request body is not valid zstd: {err}')
+        if not chunk:
+            return out
+        out += chunk
+        if len(out) > MAX_DECOMPRESSED_BYTES:
+            raise ValueError('Request body is too large once decompressed')
+
+
+def parse_body(event):
+    """Parse the JSON request body, undoing base64 and gzip/zstd encoding"""
+    body = event.get('body')
+    if not body:
+        return {}
+
+    if event.get('isBase64Encoded'):
+        raw = base64.b64decode(body)
+    elif isinstance(body, str):
+        raw = body.encode('utf-8')
+    else:
+        raw = body
+
+    encoding = _content_encoding(event)
+    if encoding == 'gzip' or (not encoding and raw[:2] == GZIP_MAGIC):
+        raw = _gunzip(raw)
+    elif encoding == 'zstd' or (not encoding and raw[:4] == ZSTD_MAGIC):
+        raw = _unzstd(raw)
+    elif encoding not in ('', 'identity'):
+        raise ValueError(f"Unsupported Content-Encoding: {encoding}")
+
+    try:
+        parsed = json.loads(raw)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
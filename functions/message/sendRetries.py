@@ -0,0 +1,344 @@
+"""Retry queue for campaign sends that failed.
+
+A failed send of a broadcast recipient is classified by its error. Transient
+and throttled failures are parked in bm-send-retries with an exponential,
+fully jittered backoff; permanent failures and items that run out of
+attempts are dead-lettered on the event (and marked failed in the delivery
+ledger). Due items are drained in batches from the sparse due-index, so an
+engine hiccup is retried a few times server-side instead of by every client.
+
+A retry row names the engine (userId + instanceId), never its address: the
+endpoint is looked up again at drain time, because a session port or public
+IP can be handed to another user's engine while the item waits.
+"""
+import json
+import os
+import random
+import time
+
+import boto3
+import requests
+
+from bmdata import SendRetry
+from engineReadiness import EngineNotReady
+from engineClient import EngineUnavailable
+from receipts import record_sent
+
+dynamodb = boto3.client('dynamodb')
+
+TRANSIENT = 'transient'
+THROTTLED = 'throttled'
+PERMANENT = 'permanent'
+
+# error class -> (first backoff seconds, backoff cap seconds, max attempts)
+RETRY_POLICIES = {
+    TRANSIENT: (5, 300, 6),
+    THROTTLED: (15, 900, 8),
+    PERMANENT: (0, 0, 1),
+}
+
+PENDING_QUEUE = 'pending'
+DUE_INDEX = 'due-index'
+DRAIN_BATCH_SIZE = 50
+# Stop claiming new batches with this much of the invocation left
+DRAIN_MARGIN_SECONDS = 2.0
+# A claimed item is invisible to other drains for this long
+CLAIM_SECONDS = 60
+RETRY_TTL_SECONDS = 7 * 24 * 60 * 60
+# The event row only carries the first dead letters; the ledger has them all
+MAX_EVENT_DEAD_LETTERS = 500
+MAX_ERROR_LENGTH = 300
+# Well under DynamoDB's 400 KB item limit, leaving room for the other attributes
+MAX_QUEUED_MESSAGE_BYTES = 350 * 1024
+
+
+def _table():
+    table = os.environ.get('SEND_RETRY_TABLE')
+    if not table:
+        raise ValueError('SEND_RETRY_TABLE environment variable is not set')
+    return table
+
+
+def classify_error(err):
+    """Error class of a failed send, or None when the request itself was invalid"""
+    if isinstance(err, EngineNotReady):
+        return TRANSIENT
+    if isinstance(err, requests.HTTPError) and err.response is not None:
+        status = err.response.status_code
+        if status == 429:
+            return THROTTLED
+        return TRANSIENT if status >= 500 else PERMANENT
+    if isinstance(err, requests.RequestException):
+        return TRANSIENT
+    if isinstance(err, ValueError):
+        return None
+    return TRANSIENT
+
+
+def backoff_seconds(error_class, attempts):
+    """Full-jitter delay before the next attempt, after `attempts` tries"""
+    first, cap, _ = RETRY_POLICIES[error_class]
+    return max(1, int(random.uniform(0, min(cap, first * 2 ** (attempts - 1)))))
+
+
+def _describe(err):
+    return f"{type(err).__name__}: {err}"[:MAX_ERROR_LENGTH]
+
+
+def _dead_letter_entry(item):
+    return {
+        'recipient': item.recipient,
+        'errorClass': item.error_class,
+        'error': item.last_error,
+        'attempts': item.attempts,
+    }
+
+
+def dead_letter(event_table, ledger_table, user_id, event_id, items):
+    """Mark exhausted items failed in the ledger and attach them to the event"""
+    now = int(time.time())
+    failed = 0
+    for item in items:
+        try:
+            dynamodb.update_item(
+                TableName=ledger_table,
+                Key={'eventId': {'S': event_id}, 'recipient': {'S': item.recipient}},
+                UpdateExpression=(
+                    'SET userId = :userId, #status = :failed, failedTime = :now, '
+                    'errorCode = :errorClass, updatedTime = :now'
+                ),
+                # A receipt that already moved the recipient on wins over our failure
+                ConditionExpression='attribute_not_exists(recipient) OR #status = :sent',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':userId': {'S': user_id},
+                    ':failed': {'S': 'failed'},
+                    ':sent': {'S': 'sent'},
+                    ':errorClass': {'S': item.error_class},
+                    ':now': {'N': str(now)},
+                }
+            )
+            failed += 1
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            pass
+
+    key = {'userId': {'S': user_id}, 'eventId': {'S': event_id}}
+    counts = {
+        ':count': {'N': str(len(items))},
+        ':failed': {'N': str(failed)},
+    }
+    entries = [{'M': {
+        name: {'N': str(value)} if isinstance(value, int) else {'S': str(value)}
+        for name, value in _dead_letter_entry(item).items()
+    }} for item in items]
+    try:
+        dynamodb.update_item(
+            TableName=event_table,
+            Key=key,
+            UpdateExpression=(
+                'SET deadLetters = list_append(if_not_exists(deadLetters, :empty), :entries) '
+                'ADD deadLetterCount :count, failureCount :failed'
+            ),
+            ConditionExpression='attribute_not_exists(deadLetters) OR size(deadLetters) < :cap',
+            ExpressionAttributeValues={
+                **counts,
+                ':empty': {'L': []},
+                ':entries': {'L': entries},
+                ':cap': {'N': str(MAX_EVENT_DEAD_LETTERS)},
+            }
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        # The event's list is full; keep counting
+        dynamodb.update_item(
+            TableName=event_table,
+            Key=key,
+            UpdateExpression='ADD deadLetterCount :count, failureCount :failed',
+            ExpressionAttributeValues=counts
+        )
+
+
+def enqueue_failed_send(event_table, ledger_table, user_id, event_id, recipient, instance_id, message, lane, err):
+    """Park a failed campaign send for retry, or dead-letter it if it cannot succeed.
+
+    Returns what the client gets back instead of an error, so it does not
+    retry the send itself.
+    """
+    error_class = classify_error(err)
+    last_error = _describe(err)
+    stored_message = json.dumps(message, separators=(',', ':'))
+    if len(stored_message.encode('utf-8')) > MAX_QUEUED_MESSAGE_BYTES:
+        # Would not fit in a DynamoDB item; a retry could not be queued anyway
+        error_class = PERMANENT
+        last_error = 'Message is too large to queue for retry'
+        stored_message = ''
+    if not instance_id:
+        error_class = PERMANENT
+        last_error = 'No engine is recorded for the send'
+    now = int(time.time())
+    item = SendRetry(
+        event_id=event_id,
+        recipient=str(recipient),
+        user_id=user_id,
+        instance_id=instance_id or '',
+        message=stored_message,
+        lane=lane,
+        attempts=1,
+        error_class=error_class,
+        last_error=last_error,
+        created_time=now,
+        expires_at=now + RETRY_TTL_SECONDS,
+    )
+    if item.attempts >= RETRY_POLICIES[error_class][2]:
+        dead_letter(event_table, ledger_table, user_id, event_id, [item])
+        return {'deadLettered': True, 'errorClass': error_class}
+
+    item.queue = PENDING_QUEUE
+    item.next_attempt_at = now + backoff_seconds(error_class, item.attempts)
+    dynamodb.put_item(TableName=_table(), Item=item.to_item())
+    return {'queued': True, 'errorClass': error_class, 'nextAttemptAt': item.next_attempt_at}
+
+
+def _due_pages(table, now, limit):
+    """Pages of due items, oldest first, following LastEvaluatedKey"""
+    params = {
+        'TableName': table,
+        'IndexName': DUE_INDEX,
+        'KeyConditionExpression': '#queue = :pending AND nextAttemptAt <= :now',
+        'ExpressionAttributeNames': {'#queue': 'queue'},
+        'ExpressionAttributeValues': {
+            ':pending': {'S': PENDING_QUEUE},
+            ':now': {'N': str(now)},
+        },
+        'Limit': limit,
+    }
+    while True:
+        response = dynamodb.query(**params)
+        yield [SendRetry.from_item(item) for item in response.get('Items', [])]
+        if 'LastEvaluatedKey' not in response:
+            return
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def _claim(table, item, now):
+    """Hide an item from concurrent drains; False if another drain got it"""
+    try:
+        dynamodb.update_item(
+            TableName=table,
+            Key={'eventId': {'S': item.event_id}, 'recipient': {'S': item.recipient}},
+            UpdateExpression='SET nextAttemptAt = :claimedUntil',
+            ConditionExpression='nextAttemptAt = :seen AND attempts = :attempts',
+            ExpressionAttributeValues={
+                ':claimedUntil': {'N': str(now + CLAIM_SECONDS)},
+                ':seen': {'N': str(item.next_attempt_at)},
+                ':attempts': {'N': str(item.attempts)},
+            }
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def _reschedule(table, item, next_attempt_at):
+    dynamodb.update_item(
+        TableName=table,
+        Key={'eventId': {'S': item.event_id}, 'recipient': {'S': item.recipient}},
+        UpdateExpression=(
+            'SET attempts = :attempts, errorClass = :errorClass, lastError = :lastError, '
+            'nextAttemptAt = :next'
+        ),
+        ExpressionAttributeValues={
+            ':attempts': {'N': str(item.attempts)},
+            ':errorClass': {'S': item.error_class},
+            ':lastError': {'S': item.last_error},
+            ':next': {'N': str(next_attempt_at)},
+        }
+    )
+
+
+def _delete(table, item):
+    dynamodb.delete_item(
+        TableName=table,
+        Key={'eventId': {'S': item.event_id}, 'recipient': {'S': item.recipient}}
+    )
+
+
+def drain_retries(send, resolve, event_table, ledger_table, deadline, batch_size=DRAIN_BATCH_SIZE):
+    """Retry due sends with send(public_url, message, deadline, lane), batch by batch.
+
+    resolve(user_id, instance_id) gives the engine's current endpoint, or
+    None once the engine is gone or not serving; such items are
+    dead-lettered. Keeps paging through the due-index until it is empty or
+    the invocation's deadline runs short; unprocessed claims become visible
+    again after CLAIM_SECONDS.
+    """
+    table = _table()
+    now = int(time.time())
+    summary = {'due': 0, 'sent': 0, 'rescheduled': 0, 'deadLettered': 0, 'skipped': 0, 'batches': 0}
+    dead_letters = {}
+    # (userId, instanceId) -> endpoint, resolved once per drain
+    endpoints = {}
+    # Engines whose circuit is open: their items wait without using an attempt
+    unavailable = {}
+
+    for items in _due_pages(table, now, batch_size):
+        if deadline.remaining() < DRAIN_MARGIN_SECONDS:
+            break
+        summary['batches'] += 1
+        summary['due'] += len(items)
+        for item in items:
+            if deadline.remaining() < DRAIN_MARGIN_SECONDS:
+                break
+            _retry_item(send, resolve, table, ledger_table, item, deadline, summary, dead_letters, endpoints, unavailable)
+
+    for (user_id, event_id), items in dead_letters.items():
+        dead_letter(event_table, ledger_table, user_id, event_id, items)
+    return summary
+
+
+def _retry_item(send, resolve, table, ledger_table, item, deadline, summary, dead_letters, endpoints, unavailable):
+    # A drain spans many batches; claims and backoffs count from when the item is handled
+    now = int(time.time())
+    if not _claim(table, item, now):
+        summary['skipped'] += 1
+        return
+
+    engine = (item.user_id, item.instance_id)
+    if engine in unavailable:
+        _reschedule(table, item, now + unavailable[engine])
+        summary['rescheduled'] += 1
+        return
+    if engine not in endpoints:
+        endpoints[engine] = resolve(item.user_id, item.instance_id) if item.instance_id else None
+    public_url = endpoints[engine]
+
+    if public_url is None:
+        # The engine was terminated or replaced; its old address may serve someone else now
+        item.attempts += 1
+        item.error_class = PERMANENT
+        item.last_error = 'Engine is no longer active'
+    else:
+        try:
+            send(public_url, json.loads(item.message), deadline, item.lane)
+            record_sent(ledger_table, item.user_id, item.event_id, item.recipient)
+            _delete(table, item)
+            summary['sent'] += 1
+            return
+        except EngineUnavailable as err:
+            # Nothing reached the engine, so this does not count as an attempt
+            unavailable[engine] = max(1, err.retry_after_ms // 1000)
+            _reschedule(table, item, now + unavailable[engine])
+            summary['rescheduled'] += 1
+            return
+        except Exception as err:
+            error_class = classify_error(err) or PERMANENT
+            item.attempts += 1
+            item.error_class = error_class
+            item.last_error = _describe(err)
+
+    if item.attempts >= RETRY_POLICIES[item.error_class][2]:
+        _delete(table, item)
+        dead_letters.setdefault((item.user_id, item.event_id), []).append(item)
+        summary['deadLettered'] += 1
+    else:
+        _reschedule(table, item, now + backoff_seconds(item.error_class, item.attempts))
+        summary['rescheduled'] += 1
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from bmdata import EngineInstance
+from engineMetrics import (
+    BUCKET_SECONDS,
+    FLEET_KEY,
+    SAMPLE_ATTRIBUTES,
+    SAMPLE_TTL_SECONDS,
+    bucket_of,
+    metrics_table,
+)
+
+dynamodb = boto3.client('dynamodb')
+
+# Engines expose their load as JSON on this path:
+#   {"cpuPercent": .., "memoryPercent": .., "queueDepth": .., "sentTotal": .., "failedTotal": ..}
+# cpuPercent/memoryPercent are of the machine the engine runs on (the host, for
+# a session container); sentTotal/failedTotal are counters since start.
+ENGINE_METRICS_PATH = os.environ.get('ENGINE_METRICS_PATH', '/metrics')
+SCRAPE_CONCURRENCY = 500
+SCRAPE_TIMEOUT_SECONDS = 2.0
+MAX_RESPONSE_BYTES = 64 * 1024
+# Leave this much of the invocation for writing the samples
+WRITE_MARGIN_SECONDS = 10.0
+BATCH_WRITE_SIZE = 25
+WRITE_THREADS = 8
+
+SCRAPED_STATES = ('booting', 'ready', 'linked')
+
+# instanceId -> (bucket, sentTotal) of the previous run in this warm container,
+# so send rates come for free when consecutive runs share a container
+_previous_sent = {}
+
+
+def list_engines(engine_table):
+    """Active engines with a reachable address"""
+    engines = []
+    scan_params = {
+        'TableName': engine_table,
+        'ExpressionAttributeValues': {':active': {'BOOL': True}},
+        **EngineInstance.projection('user_id', 'instance_id', 'host_id', 'engine_state', 'public_url', 'is_active'),
+    }
+    # projection() names its attributes #p0..; the filter reuses those placeholders
+    names = {name: placeholder for placeholder, name in scan_params['ExpressionAttributeNames'].items()}
+    scan_params['FilterExpression'] = f"{names['isActive']} = :active AND attribute_exists({names['publicUrl']})"
+    while True:
+        response = dynamodb.scan(**scan_params)
+        for item in response.get('Items', []):
+            engine = EngineInstance.from_item(item)
+            if engine.engine_state in SCRAPED_STATES or engine.engine_state is None:
+                engines.append(engine)
+        if 'LastEvaluatedKey' not in response:
+            return engines
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+async def _http_get_json(address, path):
+    """Minimal HTTP/1.0 GET; a scrape needs no keep-alive, TLS or redirects"""
+    host, _, port = address.partition(':')
+    reader, writer = await asyncio.open_connection(host, int(port or 80))
+    try:
+        writer.write(f"GET {path} HTTP/1.0\r\nHost: {host}\r\nAccept: application/json\r\n\r\n".encode('ascii'))
+        await writer.drain()
+        # HTTP/1.0: the engine closes the connection after the response
+        response = bytearray()
+        while len(response) <= MAX_RESPONSE_BYTES:
+            chunk = await reader.read(MAX_RESPONSE_BYTES)
+            if not chunk:
+                break
+            response += chunk
+        else:
+            raise ValueError('Metrics response is too large')
+    finally:
+        writer.close()
+    head, _, body = bytes(response).partition(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    if status != 200:
+        raise ValueError(f"HTTP {status}")
+    return json.loads(body)
+
+
+async def _scrape(engine, semaphore):
+    async with semaphore:
+        try:
+            metrics = await asyncio.wait_for(
+                _http_get_json(engine.public_url, ENGINE_METRICS_PATH), SCRAPE_TIMEOUT_SECONDS
+            )
+            return engine, metrics if isinstance(metrics, dict) else None
+        except Exception:
+            return engine, None
+
+
+async def scrape_all(engines, budget_seconds):
+    semaphore = asyncio.Semaphore(SCRAPE_CONCURRENCY)
+    tasks = [asyncio.ensure_future(_scrape(engine, semaphore)) for engine in engines]
+    done, pending = await asyncio.wait(tasks, timeout=budget_seconds)
+    for task in pending:
+        task.cancel()
+    return [task.result() for task in done]
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value if isinstance(value, int) else round(value, 1)
+
+
+def build_sample(engine, metrics, bucket):
+    """Compact row for one engine and minute; unreachable engines get ok = false"""
+    item = {
+        'engineKey': {'S': engine.instance_id},
+        'bucket': {'N': str(bucket)},
+        'ok': {'BOOL': metrics is not None},
+        'expiresAt': {'N': str(bucket + SAMPLE_TTL_SECONDS)},
+    }
+    if engine.host_id:
+        item['h'] = {'S': engine.host_id}
+    if metrics is None:
+        return item, {}
+
+    values = {}
+    for short, name in SAMPLE_ATTRIBUTES.items():
+        value = _number(metrics.get(name))
+        if value is not None:
+            values[short] = value
+
+    previous = _previous_sent.get(engine.instance_id)
+    if 's' in values:
+        if previous and bucket > previous[0] and values['s'] >= previous[1]:
+            values['r'] = round((values['s'] - previous[1]) * BUCKET_SECONDS / (bucket - previous[0]), 1)
+        _previous_sent[engine.instance_id] = (bucket, values['s'])
+
+    for short, value in values.items():
+        item[short] = {'N': str(value)}
+    return item, values
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def build_fleet_sample(samples, engine_count, bucket):
+    cpu = [values['c'] for values in samples if 'c' in values]
+    memory = [values['m'] for values in samples if 'm' in values]
+    item = {
+        'engineKey': {'S': FLEET_KEY},
+        'bucket': {'N': str(bucket)},
+        'n': {'N': str(engine_count)},
+        'u': {'N': str(len(samples))},
+        'q': {'N': str(sum(values.get('q', 0) for values in samples))},
+        'r': {'N': str(round(sum(values.get('r', 0) for values in samples), 1))},
+        'expiresAt': {'N': str(bucket + SAMPLE_TTL_SECONDS)},
+    }
+    if cpu:
+        item['ca'] = {'N': str(round(sum(cpu) / len(cpu), 1))}
+        item['cp'] = {'N': str(_percentile(cpu, 0.95))}
+        item['cx'] = {'N': str(max(cpu))}
+    if memory:
+        item['ma'] = {'N': str(round(sum(memory) / len(memory), 1))}
+    return item
+
+
+def _write_batch(table, items):
+    request = {table: [{'PutRequest': {'Item': item}} for item in items]}
+    for attempt in range(5):
+        response = dynamodb.batch_write_item(RequestItems=request)
+        request = response.get('UnprocessedItems') or {}
+        if not request:
+            return 0
+        time.sleep(0.05 * 2 ** attempt)
+    return len(request.get(table, []))
+
+
+def write_samples(items):
+    """BatchWriteItem in parallel threads; returns how many rows were dropped"""
+    table = metrics_table()
+    batches = [items[start:start + BATCH_WRITE_SIZE] for start in range(0, len(items), BATCH_WRITE_SIZE)]
+    with ThreadPoolExecutor(max_workers=WRITE_THREADS) as pool:
+        return sum(pool.map(lambda batch: _write_batch(table, batch), batches))
+
+
+def update_host_load(host_samples):
+    """Feed measured CPU/memory into the shared-mode host rows used for bin-packing"""
+    host_table = os.environ.get('ENGINE_HOST_TABLE')
+    if not host_table:
+        return
+    now = str(int(time.time()))
+    for host_id, samples in host_samples.items():
+        cpu = [values['c'] for values in samples if 'c' in values]
+        memory = [values['m'] for values in samples if 'm' in values]
+        if not cpu and not memory:
+            continue
+        try:
+            # Sessions on one host report the same machine; the max is robust to a stale one
+            dynamodb.update_item(
+                TableName=host_table,
+                Key={'hostId': {'S': host_id}},
+                UpdateExpression='SET cpuUtilization = :cpu, memoryUtilization = :memory, modifiedTime = :now',
+                ConditionExpression='attribute_exists(hostId)',
+                ExpressionAttributeValues={
+                    ':cpu': {'N': str(max(cpu) if cpu else 0)},
+                    ':memory': {'N': str(max(memory) if memory else 0)},
+                    ':now': {'N': now},
+                }
+            )
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            pass
+
+
+def collect(engine_table, budget_seconds):
+    started = time.monotonic()
+    bucket = bucket_of(time.time())
+    engines = list_engines(engine_table)
+    scrape_budget = max(1.0, budget_seconds - (time.monotonic() - started))
+    results = asyncio.run(scrape_all(engines, scrape_budget))
+
+    items = []
+    reachable = []
+    host_samples = {}
+    for engine, metrics in results:
+        item, values = build_sample(engine, metrics, bucket)
+        items.append(item)
+        if metrics is not None:
+            reachable.append(values)
+            if engine.host_id:
+                host_samples.setdefault(engine.host_id, []).append(values)
+    items.append(build_fleet_sample(reachable, len(engines), bucket))
+
+    dropped = write_samples(items)
+    update_host_load(host_samples)
+    return {
+        'bucket': bucket,
+        'engines': len(engines),
+        'scraped': len(results),
+        'reachable': len(reachable),
+        'droppedWrites': dropped,
+        'seconds': round(time.monotonic() - started, 2),
+    }
+
+
+def lambda_handler(event, context):
+    try:
+        engine_table = os.environ.get('ENGINE_INSTANCE_TABLE')
+        if not engine_table:
+            raise ValueError('ENGINE_INSTANCE_TABLE environment variable is not set')
+
+        remaining = context.get_remaining_time_in_millis() / 1000.0 if context else 60.0
+        summary = collect(engine_table, remaining - WRITE_MARGIN_SECONDS)
+        print(f"Telemetry collected: {json.dumps(summary)}")
+        return summary
+    except Exception as err:
+        print(f"Error collecting telemetry: {err}")
+        raise
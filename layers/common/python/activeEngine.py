@@ -0,0 +1,72 @@
+import logging
+import time
+
+import boto3
+from bmdata import EngineInstance, User
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+dynamodb = boto3.client('dynamodb')
+
+# Engines launched before the active-engine pointer existed only have their
+# bm-engine-instances row. The first lookup that finds no pointer on a user
+# row queries that user's engines once, backfills the pointer if one is still
+# active, and marks the row checked, so every later lookup is a key read.
+GONE_STATES = ('draining', 'terminated')
+
+
+def _latest_active_engine(user_id, engine_table):
+    query_params = {
+        'TableName': engine_table,
+        'KeyConditionExpression': 'userId = :userId',
+        'FilterExpression': 'isActive = :active AND (attribute_not_exists(engineState) OR NOT engineState IN (:draining, :terminated))',
+        'ExpressionAttributeValues': {
+            ':userId': {'S': user_id},
+            ':active': {'BOOL': True},
+            ':draining': {'S': GONE_STATES[0]},
+            ':terminated': {'S': GONE_STATES[1]},
+        },
+        **EngineInstance.projection('instance_id', 'created_time'),
+    }
+    latest = None
+    while True:
+        response = dynamodb.query(**query_params)
+        for item in response.get('Items', []):
+            engine = EngineInstance.from_item(item)
+            if latest is None or engine.created_time > latest.created_time:
+                latest = engine
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return latest.instance_id if latest else None
+
+
+def backfill_active_instance_id(user_id, user_table, engine_table):
+    """Current engine of a user row without a pointer, written back as the pointer"""
+    instance_id = _latest_active_engine(user_id, engine_table)
+    update_params = {
+        'TableName': user_table,
+        'Key': {'userId': {'S': user_id}},
+        'UpdateExpression': 'SET enginePointerChecked = :checked',
+        'ConditionExpression': 'attribute_exists(userId) AND attribute_not_exists(activeInstanceId)',
+        'ExpressionAttributeValues': {':checked': {'BOOL': True}},
+    }
+    if instance_id:
+        update_params['UpdateExpression'] += ', activeInstanceId = :instanceId, modifiedTime = :modifiedTime'
+        update_params['ExpressionAttributeValues'][':instanceId'] = {'S': instance_id}
+        update_params['ExpressionAttributeValues'][':modifiedTime'] = {'N': str(int(time.time()))}
+    try:
+        dynamodb.update_item(**update_params)
+        if instance_id:
+            logger.info("Backfilled active engine pointer of %s to %s", user_id, instance_id)
+        return instance_id
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        # The user is gone, or a create set the pointer meanwhile; that one wins
+        item = dynamodb.get_item(
+            TableName=user_table,
+            Key={'userId': {'S': user_id}},
+            ConsistentRead=True,
+            **User.projection('active_instance_id')
+        ).get('Item')
+        return User.from_item(item).active_instance_id if item else None
@@ -0,0 +1,19 @@
+"""Shared data-access layer for the broadcast-message functions"""
+from .codec import decode_item, decode_value, encode_item, encode_value
+from .records import ContactList, EngineHost, EngineInstance, Event, LedgerEntry, Record, SendRetry, Subscription, User
+
+__all__ = [
+    'Record',
+    'User',
+    'Subscription',
+    'EngineInstance',
+    'EngineHost',
+    'Event',
+    'ContactList',
+    'LedgerEntry',
+    'SendRetry',
+    'decode_item',
+    'decode_value',
+    'encode_item',
+    'encode_value',
+]
@@ -0,0 +1,84 @@
+"""Single-pass conversion between Python values and DynamoDB wire format"""
+
+
+def _decode_number(raw):
+    try:
+        return int(raw)
+    except ValueError:
+        return float(raw)
+
+
+def _decode_map(raw):
+    return {name: decode_value(value) for name, value in raw.items()}
+
+
+def _decode_list(raw):
+    return [decode_value(value) for value in raw]
+
+
+_DECODERS = {
+    'S': str,
+    'N': _decode_number,
+    'BOOL': bool,
+    'NULL': lambda raw: None,
+    'M': _decode_map,
+    'L': _decode_list,
+    'SS': set,
+    'NS': lambda raw: {_decode_number(number) for number in raw},
+    'B': bytes,
+    'BS': lambda raw: {bytes(blob) for blob in raw},
+}
+
+
+def decode_value(value):
+    """Decode one attribute value such as {'N': '5'} into a Python value"""
+    kind, = value
+    if kind == 'S':
+        return value['S']
+    return _DECODERS[kind](value[kind])
+
+
+def decode_item(item):
+    """Decode a whole item; attributes are visited exactly once"""
+    return {name: decode_value(value) for name, value in item.items()}
+
+
+def _encode_set(value):
+    if not value:
+        raise ValueError('DynamoDB sets cannot be empty')
+    sample = next(iter(value))
+    if isinstance(sample, str):
+        return {'SS': sorted(value)}
+    if isinstance(sample, (bytes, bytearray)):
+        return {'BS': [bytes(blob) for blob in value]}
+    return {'NS': [str(number) for number in value]}
+
+
+_ENCODERS = {
+    str: lambda value: {'S': value},
+    bool: lambda value: {'BOOL': value},
+    int: lambda value: {'N': str(value)},
+    float: lambda value: {'N': repr(value)},
+    type(None): lambda value: {'NULL': True},
+    dict: lambda value: {'M': encode_item(value)},
+    list: lambda value: {'L': [encode_value(entry) for entry in value]},
+    tuple: lambda value: {'L': [encode_value(entry) for entry in value]},
+    set: _encode_set,
+    frozenset: _encode_set,
+    bytes: lambda value: {'B': value},
+}
+
+
+def encode_value(value):
+    """Encode one Python value into its DynamoDB attribute value"""
+    if type(value) is str:
+        return {'S': value}
+    encoder = _ENCODERS.get(type(value))
+    if encoder is None:
+        raise TypeError(f"Cannot encode {type(value).__name__} for DynamoDB")
+    return encoder(value)
+
+
+def encode_item(values):
+    """Encode a dict into a DynamoDB item, dropping None values"""
+    return {name: encode_value(value) for name, value in values.items() if value is not None}
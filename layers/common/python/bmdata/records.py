@@ -0,0 +1,258 @@
+"""Typed records for the bm-* tables.
+
+Each record declares FIELDS as (slot, attribute, default) triples. Slots are
+the Python attribute names; attributes are the DynamoDB attribute names.
+"""
+from .codec import _decode_number, decode_value, encode_value
+
+# Wire type and inline conversion for fields whose default pins their type
+_FAST_PATHS = {
+    str: ('S', '{}'),
+    bool: ('BOOL', '{}'),
+    int: ('N', 'number({})'),
+}
+
+
+def _compile_codec(cls):
+    """Generate straight-line from_item/to_item functions for a record class.
+
+    Unrolling the field loop at class creation keeps per-item work down to one
+    dict lookup and one decode per field. Parsing costs about the same as the
+    hand-written .get('N', 0) chains it replaces; building visits every field
+    and is somewhat slower than a dict literal of the written attributes.
+    """
+    namespace = {'cls': cls, 'decode': decode_value, 'encode': encode_value, 'number': _decode_number}
+    decode_lines = ['def from_item(item):', '    record = cls.__new__(cls)', '    get = item.get']
+    encode_lines = ['def to_item(self):', '    item = {}']
+    for index, (slot, attribute, default) in enumerate(cls.FIELDS):
+        namespace[f"default{index}"] = default
+        decode_lines.append(f"    value = get({attribute!r})")
+        decode_lines.append(f"    if value is None:")
+        decode_lines.append(f"        record.{slot} = default{index}")
+        # Fields whose default fixes their type get an inline fast path; any
+        # other wire type still goes through the generic decoder.
+        kind, convert = _FAST_PATHS.get(type(default), (None, None))
+        if kind:
+            decode_lines.append(f"    elif {kind!r} in value:")
+            decode_lines.append(f"        record.{slot} = {convert.format(f'value[{kind!r}]')}")
+        decode_lines.append(f"    else:")
+        decode_lines.append(f"        record.{slot} = decode(value)")
+        encode_lines.append(f"    value = self.{slot}")
+        if kind:
+            encode_lines.append(f"    if type(value) is {type(default).__name__}:")
+            encode_lines.append(f"        item[{attribute!r}] = {{{kind!r}: {'str(value)' if kind == 'N' else 'value'}}}")
+            encode_lines.append(f"    elif value is not None:")
+        else:
+            encode_lines.append(f"    if value is not None:")
+        encode_lines.append(f"        item[{attribute!r}] = encode(value)")
+    decode_lines.append('    return record')
+    encode_lines.append('    return item')
+    exec('\n'.join(decode_lines + encode_lines), namespace)
+    namespace['from_item'].__doc__ = 'Build a record from a DynamoDB item, decoding each field once'
+    namespace['to_item'].__doc__ = 'Encode the record as a DynamoDB item, omitting unset (None) fields'
+    return staticmethod(namespace['from_item']), namespace['to_item']
+
+
+class Record:
+    __slots__ = ()
+    FIELDS = ()
+    KEY = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._ATTRIBUTE_BY_SLOT = {slot: attribute for slot, attribute, _ in cls.FIELDS}
+        cls._DEFAULTS = tuple((slot, default) for slot, _, default in cls.FIELDS)
+        cls._PROJECTIONS = {}
+        # from_item/to_item are generated per subclass from FIELDS
+        cls.from_item, cls.to_item = _compile_codec(cls)
+
+    def __init__(self, **values):
+        for slot, default in self._DEFAULTS:
+            setattr(self, slot, values.pop(slot, default))
+        if values:
+            raise TypeError(f"Unknown {type(self).__name__} fields: {', '.join(values)}")
+
+    def __repr__(self):
+        fields = ', '.join(f"{slot}={getattr(self, slot)!r}" for slot, _ in self._DEFAULTS)
+        return f"{type(self).__name__}({fields})"
+
+    def to_dict(self):
+        """Plain dict keyed by attribute name, ready for json.dumps"""
+        return {attribute: getattr(self, slot) for slot, attribute, _ in self.FIELDS}
+
+    def key(self):
+        return {self._ATTRIBUTE_BY_SLOT[slot]: encode_value(getattr(self, slot)) for slot in self.KEY}
+
+    @classmethod
+    def projection(cls, *slots):
+        """ProjectionExpression kwargs fetching only the given fields.
+
+        Attribute names are always aliased so reserved words such as name and
+        status need no special casing. Results are cached per slot tuple.
+        """
+        cached = cls._PROJECTIONS.get(slots)
+        if cached is None:
+            names = {f"#p{index}": cls._ATTRIBUTE_BY_SLOT[slot] for index, slot in enumerate(slots)}
+            cached = {
+                'ProjectionExpression': ', '.join(names),
+                'ExpressionAttributeNames': names,
+            }
+            cls._PROJECTIONS[slots] = cached
+        return {
+            'ProjectionExpression': cached['ProjectionExpression'],
+            'ExpressionAttributeNames': dict(cached['ExpressionAttributeNames']),
+        }
+
+
+class User(Record):
+    FIELDS = (
+        ('user_id', 'userId', ''),
+        ('name', 'name', ''),
+        ('password', 'password', ''),
+        ('phone', 'phone', ''),
+        ('is_active', 'isActive', False),
+        ('created_time', 'createdTime', 0),
+        ('modified_time', 'modifiedTime', 0),
+        ('active_instance_id', 'activeInstanceId', None),
+        ('engine_lease_id', 'engineLeaseId', None),
+        ('engine_lease_expires_at', 'engineLeaseExpiresAt', None),
+        ('engine_lease_instance_id', 'engineLeaseInstanceId', None),
+        ('engine_pointer_checked', 'enginePointerChecked', None),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+    KEY = ('user_id',)
+
+
+class Subscription(Record):
+    FIELDS = (
+        ('user_id', 'userId', ''),
+        ('message_count_used', 'messageCountUsed', 0),
+        ('message_count_left', 'messageCountLeft', 0),
+        ('engine_hour_used', 'engineHourUsed', 0),
+        ('engine_hour_left', 'engineHourLeft', 0),
+        ('modified_time', 'modifiedTime', 0),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+    KEY = ('user_id',)
+
+
+class EngineInstance(Record):
+    FIELDS = (
+        ('user_id', 'userId', ''),
+        ('instance_id', 'instanceId', ''),
+        ('created_time', 'createdTime', 0),
+        ('is_active', 'isActive', False),
+        ('whatsapp_link_time', 'whatsappLinkTime', None),
+        ('terminated_time', 'terminatedTime', None),
+        ('subnet_id', 'subnetId', None),
+        ('instance_type', 'instanceType', None),
+        ('availability_zone', 'availabilityZone', None),
+        ('host_id', 'hostId', None),
+        ('host_port', 'hostPort', None),
+        ('container_started', 'containerStarted', None),
+        ('engine_state', 'engineState', None),
+        ('state_changed_time', 'stateChangedTime', None),
+        ('probe_count', 'probeCount', None),
+        ('public_url', 'publicUrl', None),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+    KEY = ('user_id', 'instance_id')
+
+
+class EngineHost(Record):
+    FIELDS = (
+        ('host_id', 'hostId', ''),
+        ('host_state', 'hostState', 'active'),
+        ('public_ip', 'publicIp', None),
+        ('max_sessions', 'maxSessions', 0),
+        ('session_count', 'sessionCount', 0),
+        ('used_ports', 'usedPorts', None),
+        ('cpu_utilization', 'cpuUtilization', None),
+        ('memory_utilization', 'memoryUtilization', None),
+        ('created_time', 'createdTime', 0),
+        ('modified_time', 'modifiedTime', 0),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+    KEY = ('host_id',)
+
+
+class Event(Record):
+    FIELDS = (
+        ('user_id', 'userId', ''),
+        ('event_id', 'eventId', ''),
+        ('instance_id', 'instanceId', ''),
+        ('created_time', 'createdTime', 0),
+        ('title', 'title', ''),
+        ('description', 'description', ''),
+        ('editor_value', 'editorValue', ''),
+        ('message_text', 'messageText', ''),
+        ('is_completed', 'isCompleted', False),
+        ('recipient_count', 'recipientCount', 0),
+        ('success_count', 'successCount', 0),
+        ('failure_count', 'failureCount', 0),
+        ('delivered_count', 'deliveredCount', 0),
+        ('read_count', 'readCount', 0),
+        ('status', 'status', 'unknown'),
+        ('completed_time', 'completedTime', None),
+        ('contact_list', 'contactList', None),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+    KEY = ('user_id', 'event_id')
+
+
+class ContactList(Record):
+    """One row per list (listRef = listId) plus one per version (listRef = listId@version)"""
+    FIELDS = (
+        ('user_id', 'userId', ''),
+        ('list_ref', 'listRef', ''),
+        ('list_id', 'listId', ''),
+        ('name', 'name', ''),
+        ('version', 'version', 0),
+        ('latest_version', 'latestVersion', None),
+        ('object_key', 'objectKey', None),
+        ('contact_count', 'contactCount', 0),
+        ('created_time', 'createdTime', 0),
+        ('modified_time', 'modifiedTime', 0),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+    KEY = ('user_id', 'list_ref')
+
+
+class LedgerEntry(Record):
+    """Per-recipient delivery state of a broadcast, in bm-delivery-ledger"""
+    FIELDS = (
+        ('event_id', 'eventId', ''),
+        ('recipient', 'recipient', ''),
+        ('user_id', 'userId', ''),
+        ('status', 'status', 'sent'),
+        ('message_id', 'messageId', None),
+        ('sent_time', 'sentTime', None),
+        ('delivered_time', 'deliveredTime', None),
+        ('read_time', 'readTime', None),
+        ('failed_time', 'failedTime', None),
+        ('error_code', 'errorCode', None),
+        ('updated_time', 'updatedTime', 0),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+    KEY = ('event_id', 'recipient')
+
+
+class SendRetry(Record):
+    """A campaign send waiting for another attempt, in bm-send-retries"""
+    FIELDS = (
+        ('event_id', 'eventId', ''),
+        ('recipient', 'recipient', ''),
+        ('user_id', 'userId', ''),
+        ('instance_id', 'instanceId', ''),
+        ('message', 'message', ''),
+        ('lane', 'lane', 'bulk'),
+        ('attempts', 'attempts', 0),
+        ('error_class', 'errorClass', None),
+        ('last_error', 'lastError', None),
+        ('queue', 'queue', None),
+        ('next_attempt_at', 'nextAttemptAt', 0),
+        ('created_time', 'createdTime', 0),
+        ('expires_at', 'expiresAt', 0),
+    )
+    __slots__ = tuple(field[0] for field in FIELDS)
+    KEY = ('event_id', 'recipient')
@@ -0,0 +1,348 @@
+import boto3
+import base64
+import json
+import logging
+import os
+import random
+import time
+from botocore.exceptions import ClientError, BotoCoreError
+
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# AWS Configuration
+aws_region = 'ap-southeast-1'
+aws_access_key_id = "abc"
+aws_secret_access_key = "dfd"
+
+# Initialize AWS clients with error handling
+try:
+    ec2 = boto3.client(
+        'ec2', 
+        region_name=aws_region, 
+        aws_access_key_id=aws_access_key_id, 
+        aws_secret_access_key=aws_secret_access_key
+    )
+    ssm = boto3.client(
+        'ssm', 
+        region_name=aws_region, 
+        aws_access_key_id=aws_access_key_id, 
+        aws_secret_access_key=aws_secret_access_key
+    )
+except Exception as e:
+    logger.error(f"Failed to initialize AWS clients: {e}")
+    raise
+
+ENGINE_IMAGE = "877346214550.dkr.ecr.ap-southeast-1.amazonaws.com/messgae:latest"
+
+# EC2 instance parameter
+params = {
+    "ImageId": "ami-041d098a1f645b918",
+    "InstanceType": "t3.micro",
+    "MinCount": 1,
+    "MaxCount": 1,
+    "KeyName": "message",
+    "SecurityGroupIds": ["sg-083ba73b7d582f339"],
+    "SubnetId": "subnet-0febf74469aa28417",
+    "InstanceInitiatedShutdownBehavior": "terminate",
+    "IamInstanceProfile": {"Name": "message-ec2"},
+    "BlockDeviceMappings": [
+        {
+            "DeviceName": "/dev/xvda",
+            "Ebs": {
+                "VolumeSize": 8,
+                "VolumeType": "gp3",
+                "DeleteOnTermination": True
+            }
+        }
+    ],
+    "UserData": base64.b64encode(
+        f"#!/bin/bash\ndocker run -p 80:80 {ENGINE_IMAGE}".encode()
+    ).decode('utf-8')
+}
+
+# Ordered launch placements, tried first to last. Override per stage with the
+# ENGINE_PLACEMENTS environment variable (JSON list of {SubnetId, InstanceType}),
+# set from the template's EnginePlacements parameter. These defaults share one
+# subnet, so they only fall back across instance types within a single AZ.
+DEFAULT_PLACEMENTS = [
+    {"SubnetId": params["SubnetId"], "InstanceType": "t3.micro"},
+    {"SubnetId": params["SubnetId"], "InstanceType": "t3a.micro"},
+    {"SubnetId": params["SubnetId"], "InstanceType": "t2.micro"},
+]
+
+# Errors meaning "this subnet/instance type cannot take us right now"
+CAPACITY_ERROR_CODES = {
+    'InsufficientInstanceCapacity',
+    'InsufficientHostCapacity',
+    'InsufficientFreeAddressesInSubnet',
+    'Unsupported',
+}
+# Errors meaning "ask again more slowly", independent of placement
+THROTTLE_ERROR_CODES = {'RequestLimitExceeded', 'Throttling', 'ThrottlingException'}
+
+PLACEMENT_COOLDOWN_SECONDS = 300
+LAUNCH_TIME_BUDGET_SECONDS = 12
+MAX_THROTTLE_RETRIES = 3
+BACKOFF_BASE_SECONDS = 0.25
+BACKOFF_CAP_SECONDS = 2.0
+
+# Placement key -> monotonic time until which it is skipped. Lives for the
+# warm container so consecutive launches avoid a subnet that just failed.
+_placement_cooldowns = {}
+_last_successful_placement = {}
+
+
+def _placement_key(placement):
+    return f"{placement['SubnetId']}/{placement['InstanceType']}"
+
+
+def get_placements():
+    configured = os.environ.get('ENGINE_PLACEMENTS')
+    if configured:
+        return json.loads(configured)
+    return DEFAULT_PLACEMENTS
+
+
+def plan_placements(placements=None):
+    """Healthy placements (last success first, then configured order), then
+    cooling ones soonest-expiring first as a last resort"""
+    now = time.monotonic()
+    healthy, cooling = [], []
+    for placement in placements or get_placements():
+        until = _placement_cooldowns.get(_placement_key(placement), 0)
+        if until > now:
+            cooling.append((until, placement))
+        elif _last_successful_placement.get('key') == _placement_key(placement):
+            healthy.insert(0, placement)
+        else:
+            healthy.append(placement)
+    return healthy + [placement for _, placement in sorted(cooling, key=lambda entry: entry[0])]
+
+
+def _backoff(attempt):
+    # Full jitter: spreads concurrent launches out instead of retrying in lockstep
+    time.sleep(random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))))
+
+
+def launch_engine_instance(user_id, user_data=None, tags=None, placements=None, time_budget=LAUNCH_TIME_BUDGET_SECONDS):
+    """Launch an engine, falling back across placements on capacity errors.
+
+    Returns {'instanceId', 'subnetId', 'instanceType', 'availabilityZone'}.
+    Raises RuntimeError when every placement failed within the time budget;
+    API throttling is backed off and, if it persists, re-raised as is.
+    """
+    if not user_id:
+        raise ValueError("User ID is required to create an EC2 instance.")
+
+    started = time.monotonic()
+    attempt = 0
+    last_error = None
+    instance_tags = [{"Key": "UserId", "Value": str(user_id)}] + (tags or [])
+
+    for placement in plan_placements(placements):
+        throttle_retries = 0
+        while time.monotonic() - started < time_budget:
+            launch_params = dict(
+                params,
+                SubnetId=placement['SubnetId'],
+                InstanceType=placement['InstanceType'],
+                # Tag at launch rather than with a second create_tags call
+                TagSpecifications=[{"ResourceType": "instance", "Tags": instance_tags}],
+            )
+            if user_data is not None:
+                launch_params['UserData'] = base64.b64encode(user_data.encode()).decode('utf-8')
+
+            try:
+                data = ec2.run_instances(**launch_params)
+            except ClientError as e:
+                error_code = e.response['Error']['Code']
+                last_error = f"{error_code} in {_placement_key(placement)}"
+                attempt += 1
+                if error_code in THROTTLE_ERROR_CODES:
+                    # Account-wide API throttle, not a placement problem: another
+                    # placement would be throttled too, so never cool this one
+                    if throttle_retries >= MAX_THROTTLE_RETRIES or time.monotonic() - started >= time_budget:
+                        raise
+                    throttle_retries += 1
+                    logger.warning('EC2 launch throttled (%s), backing off', error_code)
+                    _backoff(attempt)
+                    continue
+                if error_code in CAPACITY_ERROR_CODES:
+                    logger.warning('Placement %s unavailable: %s', _placement_key(placement), error_code)
+                    _placement_cooldowns[_placement_key(placement)] = time.monotonic() + PLACEMENT_COOLDOWN_SECONDS
+                    _backoff(attempt)
+                    break
+                raise
+
+            if 'Instances' not in data or not data['Instances']:
+                raise RuntimeError("Failed to create EC2 instance. No instance information returned.")
+
+            instance = data['Instances'][0]
+            _placement_cooldowns.pop(_placement_key(placement), None)
+            _last_successful_placement['key'] = _placement_key(placement)
+            result = {
+                'instanceId': instance['InstanceId'],
+                'subnetId': placement['SubnetId'],
+                'instanceType': placement['InstanceType'],
+                'availabilityZone': instance.get('Placement', {}).get('AvailabilityZone'),
+            }
+            logger.info('EC2 Instance launched: %s', result)
+            return result
+
+    raise RuntimeError(f"No placement could launch an engine: {last_error or 'time budget exhausted'}")
+
+
+def terminate_aws_ec2_instance(instance_id):
+    """Terminate EC2 instance with proper error handling"""
+    try:
+        if not instance_id:
+            raise ValueError("Instance ID is required to terminate an EC2 instance.")
+        
+        logger.info(f"Terminating EC2 instance: {instance_id}")
+        
+        # Check if instance exists and get its current state
+        try:
+            response = ec2.describe_instances(InstanceIds=[instance_id])
+            if not response['Reservations']:
+                logger.warning(f"Instance {instance_id} not found, may already be terminated")
+                return {"message": "Instance not found or already terminated"}
+                
+            instance_state = response['Reservations'][0]['Instances'][0]['State']['Name']
+            if instance_state in ['terminated', 'terminating']:
+                logger.info(f"Instance {instance_id} is already {instance_state}")
+                return {"message": f"Instance already {instance_state}"}
+                
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+                logger.warning(f"Instance {instance_id} not found")
+                return {"message": "Instance not found"}
+            raise
+        
+        # Terminate the instance
+        response = ec2.terminate_instances(InstanceIds=[instance_id])
+        
+        if 'TerminatingInstances' not in response or not response['TerminatingInstances']:
+            raise RuntimeError("Failed to terminate EC2 instance. No termination information returned.")
+        
+        termination_info = response['TerminatingInstances'][0]
+        logger.info(f'EC2 Instance termination initiated: {termination_info}')
+        
+        return {
+            "instanceId": instance_id,
+            "currentState": termination_info.get('CurrentState', {}).get('Name'),
+            "previousState": termination_info.get('PreviousState', {}).get('Name')
+        }
+        
+    except ClientError as e:
+        error_code = e.response['Error']['Code']
+        error_message = e.response['Error']['Message']
+        logger.error(f'AWS ClientError terminating EC2 instance: {error_code} - {error_message}')
+        
+        if error_code == 'InvalidInstanceID.NotFound':
+            return {"message": "Instance not found or already terminated"}
+        elif error_code == 'UnauthorizedOperation':
+            raise RuntimeError("Insufficient permissions to terminate EC2 instance")
+        else:
+            raise RuntimeError(f"AWS error terminating instance: {error_message}")
+            
+    except BotoCoreError as e:
+        logger.error(f'BotoCoreError terminating EC2 instance: {e}')
+        raise RuntimeError("Network or configuration error while terminating instance")
+        
+    except Exception as e:
+        logger.error(f'Unexpected error terminating EC2 instance: {e}')
+        raise RuntimeError(f"Failed to terminate EC2 instance: {str(e)}")
+
+def call_describe_instances(params):
+    try:
+        if not params:
+            raise ValueError("Parameters are required to describe EC2 instances.")
+        
+        response = ec2.describe_instances(**params)
+        logger.info('Describe Instances response: %s', response)
+        return response
+    except boto3.exceptions.Boto3Error as boto_err:
+        logger.error('AWS SDK error while describing EC2 instances: %s', boto_err)
+    except Exception as err:
+        logger.error('Error describing EC2 instances: %s', err)
+    return None
+
+def is_registered_with_ssm(instance_id):
+    ssm_status = ssm.describe_instance_information(
+        Filters=[{"Key": "InstanceIds", "Values": [instance_id]}]
+    )
+    return any(info['InstanceId'] == instance_id for info in ssm_status.get('InstanceInformationList', []))
+
+def run_ssm_shell_command(instance_id, command):
+    if not is_registered_with_ssm(instance_id):
+        logger.warning("Instance not yet registered with SSM. Retrying...")
+        return {"error": "Instance not registered with SSM"}
+
+    logger.info("Instance registered with SSM")
+
+    ssm_params = {
+        "DocumentName": "AWS-RunShellScript",
+        "InstanceIds": [instance_id],
+        "Parameters": {"commands": [command]}
+    }
+
+    ssm_response = ssm.send_command(**ssm_params)
+    if 'Command' not in ssm_response or 'CommandId' not in ssm_response['Command']:
+        raise RuntimeError("Failed to send SSM command. No command information returned.")
+
+    logger.info('SSM Command triggered: %s', ssm_response)
+    return {
+        "instanceId": instance_id,
+        "ssmCommandId": ssm_response['Command']['CommandId']
+    }
+
+def wait_for_ssm_command(instance_id, command_id, timeout_seconds):
+    """Final status of an SSM command ('Success', 'Failed', ...), or None if it is still running"""
+    give_up_at = time.monotonic() + timeout_seconds
+    while time.monotonic() < give_up_at:
+        time.sleep(0.5)
+        try:
+            invocation = ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
+        except ClientError as e:
+            # The invocation is not visible for a moment after send_command
+            if e.response['Error']['Code'] == 'InvocationDoesNotExist':
+                continue
+            raise
+        if invocation['Status'] not in ('Pending', 'InProgress', 'Delayed'):
+            return invocation['Status']
+    return None
+
+def start_docker_on_ec2_instance(instance_id, host_port=80, container_name=None):
+    try:
+        if not instance_id:
+            raise ValueError("Instance ID is required to start Docker on EC2 instance.")
+        
+        name_option = f"-d --restart unless-stopped --name {container_name} " if container_name else ""
+        command = f"docker run {name_option}-p {int(host_port)}:80 {ENGINE_IMAGE}"
+        if container_name:
+            # A leftover container of an earlier session would hold the name and port
+            command = f"docker rm -f {container_name} >/dev/null 2>&1; {command}"
+        return run_ssm_shell_command(instance_id, command)
+    except boto3.exceptions.Boto3Error as boto_err:
+        logger.error('AWS SDK error while starting Docker on EC2 instance: %s', boto_err)
+    except Exception as err:
+        logger.error('Error starting Docker on EC2 instance: %s', err)
+    return None
+
+def stop_docker_on_ec2_instance(instance_id, container_name):
+    try:
+        if not instance_id or not container_name:
+            raise ValueError("Instance ID and container name are required to stop Docker on EC2 instance.")
+
+        # Succeeds only once the container is gone, whether or not it existed
+        return run_ssm_shell_command(
+            instance_id, f"docker rm -f {container_name} >/dev/null 2>&1; ! docker inspect {container_name} >/dev/null 2>&1"
+        )
+    except boto3.exceptions.Boto3Error as boto_err:
+        logger.error('AWS SDK error while stopping Docker on EC2 instance: %s', boto_err)
+    except Exception as err:
+        logger.error('Error stopping Docker on EC2 instance: %s', err)
+    return None
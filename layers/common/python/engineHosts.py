@@ -0,0 +1,311 @@
+import json
+import logging
+import os
+import time
+
+import boto3
+from bmdata import EngineHost
+from ec2Client import (
+    ENGINE_IMAGE,
+    call_describe_instances,
+    launch_engine_instance,
+    start_docker_on_ec2_instance,
+    stop_docker_on_ec2_instance,
+    terminate_aws_ec2_instance,
+    wait_for_ssm_command,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+dynamodb = boto3.client('dynamodb')
+
+# Multi-tenant hosts run one WhatsApp session container per port. Limits are
+# per host; CPU/memory come from the host row, kept fresh by the telemetry
+# collector, and a host over either limit takes no new sessions.
+HOST_MAX_SESSIONS = int(os.environ.get('ENGINE_HOST_MAX_SESSIONS', '24'))
+HOST_CPU_LIMIT = 75.0
+HOST_MEMORY_LIMIT = 80.0
+SESSION_PORT_BASE = 8001
+
+# A host drains (takes no new sessions, terminated once empty) when it runs at
+# or below this fraction of its capacity and the other hosts can absorb it.
+DRAIN_LOAD_FRACTION = 0.25
+
+# Ordered host launch placements. Override per stage with ENGINE_HOST_PLACEMENTS
+# (the template's EngineHostPlacements parameter); these defaults share one
+# subnet and therefore one AZ.
+DEFAULT_HOST_PLACEMENTS = [
+    {"SubnetId": "subnet-0febf74469aa28417", "InstanceType": "t3.xlarge"},
+    {"SubnetId": "subnet-0febf74469aa28417", "InstanceType": "t3a.xlarge"},
+    {"SubnetId": "subnet-0febf74469aa28417", "InstanceType": "m6i.xlarge"},
+]
+
+HOST_USER_DATA = f"#!/bin/bash\ndocker pull {ENGINE_IMAGE}\n"
+
+ACTIVE = 'active'
+DRAINING = 'draining'
+
+# How long releasing a session waits for its container to be removed
+CONTAINER_REMOVE_WAIT_SECONDS = 8
+
+
+def is_shared_mode():
+    return os.environ.get('ENGINE_MODE') == 'shared'
+
+
+def _host_table():
+    table = os.environ.get('ENGINE_HOST_TABLE')
+    if not table:
+        raise ValueError('ENGINE_HOST_TABLE environment variable is not set')
+    return table
+
+
+def _host_placements():
+    configured = os.environ.get('ENGINE_HOST_PLACEMENTS')
+    if configured:
+        return json.loads(configured)
+    return DEFAULT_HOST_PLACEMENTS
+
+
+def session_container_name(port):
+    return f"bm-session-{int(port)}"
+
+
+def list_hosts():
+    """All non-retired hosts; the fleet is small enough for a scan"""
+    hosts = []
+    scan_params = {'TableName': _host_table()}
+    while True:
+        response = dynamodb.scan(**scan_params)
+        hosts.extend(EngineHost.from_item(item) for item in response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return hosts
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def get_host(host_id):
+    item = dynamodb.get_item(TableName=_host_table(), Key={'hostId': {'S': host_id}}).get('Item')
+    return EngineHost.from_item(item) if item else None
+
+
+def has_room(host):
+    return (
+        host.host_state == ACTIVE
+        and host.session_count < host.max_sessions
+        and (host.cpu_utilization or 0) < HOST_CPU_LIMIT
+        and (host.memory_utilization or 0) < HOST_MEMORY_LIMIT
+    )
+
+
+def free_port(host):
+    used = host.used_ports or set()
+    for port in range(SESSION_PORT_BASE, SESSION_PORT_BASE + host.max_sessions):
+        if port not in used:
+            return port
+    return None
+
+
+def _claim_port(host, port):
+    """Atomically take one session slot and port on a host; False if we lost a race"""
+    try:
+        dynamodb.update_item(
+            TableName=_host_table(),
+            Key={'hostId': {'S': host.host_id}},
+            UpdateExpression='ADD sessionCount :one, usedPorts :ports SET modifiedTime = :now',
+            ConditionExpression='hostState = :active AND sessionCount < maxSessions AND NOT contains(usedPorts, :port)',
+            ExpressionAttributeValues={
+                ':one': {'N': '1'},
+                ':ports': {'NS': [str(port)]},
+                ':port': {'N': str(port)},
+                ':active': {'S': ACTIVE},
+                ':now': {'N': str(int(time.time()))},
+            }
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def _launch_host(user_id):
+    launch = launch_engine_instance(
+        user_id,
+        user_data=HOST_USER_DATA,
+        tags=[{"Key": "Role", "Value": "engine-host"}],
+        placements=_host_placements(),
+    )
+    now = int(time.time())
+    host = EngineHost(
+        host_id=launch['instanceId'],
+        host_state=ACTIVE,
+        max_sessions=HOST_MAX_SESSIONS,
+        session_count=1,
+        used_ports={SESSION_PORT_BASE},
+        created_time=now,
+        modified_time=now,
+    )
+    dynamodb.put_item(
+        TableName=_host_table(),
+        Item=host.to_item(),
+        ConditionExpression='attribute_not_exists(hostId)'
+    )
+    logger.info('Launched engine host %s for %s', host.host_id, user_id)
+    return host
+
+
+def assign_session(user_id):
+    """Place a user's session on a host and start its container.
+
+    Best fit: the fullest host that still has room wins, so load concentrates
+    on few hosts and lightly used ones empty out and can be drained. A new
+    host is launched only when no existing host can take the session.
+
+    Returns {'hostId', 'hostPort', 'containerStarted'}.
+    """
+    candidates = sorted((host for host in list_hosts() if has_room(host)), key=lambda host: -host.session_count)
+    for host in candidates:
+        port = free_port(host)
+        if port is not None and _claim_port(host, port):
+            started = start_docker_on_ec2_instance(host.host_id, port, session_container_name(port))
+            return {
+                'hostId': host.host_id,
+                'hostPort': port,
+                'containerStarted': bool(started and 'ssmCommandId' in started),
+            }
+
+    # The new host is still booting, so its container is started later, once
+    # the host has registered with SSM (see ensure_session_container)
+    host = _launch_host(user_id)
+    return {'hostId': host.host_id, 'hostPort': SESSION_PORT_BASE, 'containerStarted': False}
+
+
+def ensure_session_container(host_id, port):
+    """Start a session container on a host that was booting at assignment time"""
+    started = start_docker_on_ec2_instance(host_id, port, session_container_name(port))
+    return bool(started and 'ssmCommandId' in started)
+
+
+def get_host_public_ip(host):
+    if host.public_ip:
+        return host.public_ip
+
+    data = call_describe_instances({
+        'Filters': [{'Name': 'instance-state-name', 'Values': ['running']}],
+        'InstanceIds': [host.host_id]
+    })
+    if not data or not data.get('Reservations'):
+        return None
+    public_ip = data['Reservations'][0]['Instances'][0].get('PublicIpAddress')
+    if public_ip:
+        dynamodb.update_item(
+            TableName=_host_table(),
+            Key={'hostId': {'S': host.host_id}},
+            UpdateExpression='SET publicIp = :publicIp',
+            ExpressionAttributeValues={':publicIp': {'S': public_ip}}
+        )
+        host.public_ip = public_ip
+    return public_ip
+
+
+def get_session_endpoint(host_id, port):
+    """host:port of a session, or None while the host has no public IP yet"""
+    host = get_host(host_id)
+    if not host:
+        raise ValueError('Engine host not found')
+    public_ip = get_host_public_ip(host)
+    return f"{public_ip}:{port}" if public_ip else None
+
+
+def _retire_host(host_id):
+    """Terminate a draining host once its last session is gone"""
+    try:
+        dynamodb.delete_item(
+            TableName=_host_table(),
+            Key={'hostId': {'S': host_id}},
+            ConditionExpression='hostState = :draining AND sessionCount <= :zero',
+            ExpressionAttributeValues={':draining': {'S': DRAINING}, ':zero': {'N': '0'}}
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+    terminate_aws_ec2_instance(host_id)
+    logger.info('Retired drained engine host %s', host_id)
+    return True
+
+
+def _maybe_drain(host, hosts):
+    """Drain a lightly loaded host if the rest of the fleet can absorb its sessions"""
+    if host.host_state != ACTIVE or host.session_count > host.max_sessions * DRAIN_LOAD_FRACTION:
+        return False
+
+    spare = sum(
+        other.max_sessions - other.session_count
+        for other in hosts
+        if other.host_id != host.host_id and has_room(other)
+    )
+    if spare <= host.session_count:
+        return False
+
+    try:
+        dynamodb.update_item(
+            TableName=_host_table(),
+            Key={'hostId': {'S': host.host_id}},
+            UpdateExpression='SET hostState = :draining, modifiedTime = :now',
+            ConditionExpression='hostState = :active',
+            ExpressionAttributeValues={
+                ':draining': {'S': DRAINING},
+                ':active': {'S': ACTIVE},
+                ':now': {'N': str(int(time.time()))},
+            }
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+    logger.info('Draining engine host %s (%s sessions)', host.host_id, host.session_count)
+    host.host_state = DRAINING
+    return True
+
+
+def _remove_session_container(host_id, port):
+    """Remove a session's container and wait for it; raises if it may still be running"""
+    container_name = session_container_name(port)
+    removal = stop_docker_on_ec2_instance(host_id, container_name)
+    if removal and removal.get('error'):
+        # Not registered with SSM: the host never got far enough to run the container
+        logger.info('Host %s is not reachable over SSM, nothing to remove', host_id)
+        return
+    status = None
+    if removal and 'ssmCommandId' in removal:
+        status = wait_for_ssm_command(host_id, removal['ssmCommandId'], CONTAINER_REMOVE_WAIT_SECONDS)
+    if status != 'Success':
+        raise RuntimeError(f"Container {container_name} on {host_id} was not removed ({status or 'no result'})")
+
+
+def release_session(host_id, port):
+    """Stop a session container, free its slot and consolidate the fleet.
+
+    The port is only given back once the container is gone, so the next
+    session assigned to it cannot collide with the old container.
+    """
+    _remove_session_container(host_id, port)
+    try:
+        response = dynamodb.update_item(
+            TableName=_host_table(),
+            Key={'hostId': {'S': host_id}},
+            UpdateExpression='ADD sessionCount :minusOne DELETE usedPorts :ports SET modifiedTime = :now',
+            ConditionExpression='attribute_exists(hostId) AND contains(usedPorts, :port)',
+            ExpressionAttributeValues={
+                ':minusOne': {'N': '-1'},
+                ':ports': {'NS': [str(port)]},
+                ':port': {'N': str(port)},
+                ':now': {'N': str(int(time.time()))},
+            },
+            ReturnValues='ALL_NEW'
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        logger.info('Session %s:%s already released', host_id, port)
+        return None
+    host = EngineHost.from_item(response['Attributes'])
+
+    _maybe_drain(host, list_hosts())
+    if host.host_state == DRAINING and host.session_count <= 0:
+        _retire_host(host_id)
+    return host
@@ -0,0 +1,98 @@
+"""Engine load samples written by the telemetry collector, and their aggregates.
+
+bm-engine-metrics holds one compact row per engine per minute
+(engineKey = instanceId, bucket = minute start) plus one fleet-wide row per
+minute (engineKey = FLEET_KEY). Rows expire after SAMPLE_TTL_SECONDS.
+"""
+import os
+import time
+
+import boto3
+from bmdata import decode_item
+
+dynamodb = boto3.client('dynamodb')
+
+FLEET_KEY = 'fleet'
+BUCKET_SECONDS = 60
+SAMPLE_TTL_SECONDS = 24 * 60 * 60
+
+# Short attribute names keep thousands of rows a minute cheap to write
+SAMPLE_ATTRIBUTES = {
+    'c': 'cpuPercent',
+    'm': 'memoryPercent',
+    'q': 'queueDepth',
+    's': 'sentTotal',
+    'f': 'failedTotal',
+    'r': 'sendRatePerMinute',
+}
+FLEET_ATTRIBUTES = {
+    'n': 'engines',
+    'u': 'reachable',
+    'ca': 'avgCpuPercent',
+    'cp': 'p95CpuPercent',
+    'cx': 'maxCpuPercent',
+    'ma': 'avgMemoryPercent',
+    'q': 'queueDepth',
+    'r': 'sendRatePerMinute',
+}
+
+
+def metrics_table():
+    table = os.environ.get('ENGINE_METRICS_TABLE')
+    if not table:
+        raise ValueError('ENGINE_METRICS_TABLE environment variable is not set')
+    return table
+
+
+def bucket_of(timestamp):
+    return int(timestamp) // BUCKET_SECONDS * BUCKET_SECONDS
+
+
+def _recent(engine_key, minutes):
+    since = bucket_of(time.time()) - (minutes - 1) * BUCKET_SECONDS
+    response = dynamodb.query(
+        TableName=metrics_table(),
+        KeyConditionExpression='engineKey = :engineKey AND bucket >= :since',
+        ExpressionAttributeValues={
+            ':engineKey': {'S': engine_key},
+            ':since': {'N': str(since)},
+        }
+    )
+    return [decode_item(item) for item in response.get('Items', [])]
+
+
+def _average(values):
+    return round(sum(values) / len(values), 1) if values else None
+
+
+def get_engine_metrics(instance_id, minutes=5):
+    """Load of one engine over the last minutes: averages, peaks and send rate"""
+    samples = [row for row in _recent(instance_id, minutes) if row.get('ok')]
+    if not samples:
+        return {'samples': 0}
+
+    cpu = [row['c'] for row in samples if 'c' in row]
+    memory = [row['m'] for row in samples if 'm' in row]
+    queue = [row['q'] for row in samples if 'q' in row]
+    sent = [(row['bucket'], row['s']) for row in samples if 's' in row]
+    send_rate = None
+    if len(sent) >= 2 and sent[-1][1] >= sent[0][1]:
+        send_rate = round((sent[-1][1] - sent[0][1]) * BUCKET_SECONDS / max(BUCKET_SECONDS, sent[-1][0] - sent[0][0]), 1)
+    return {
+        'samples': len(samples),
+        'lastSampleTime': samples[-1]['bucket'],
+        'avgCpuPercent': _average(cpu),
+        'maxCpuPercent': max(cpu) if cpu else None,
+        'avgMemoryPercent': _average(memory),
+        'maxMemoryPercent': max(memory) if memory else None,
+        'queueDepth': queue[-1] if queue else None,
+        'sendRatePerMinute': send_rate,
+    }
+
+
+def get_fleet_metrics(minutes=15):
+    """Per-minute fleet aggregates, oldest first, with readable names"""
+    return [
+        {'bucket': row['bucket'], **{name: row[short] for short, name in FLEET_ATTRIBUTES.items() if short in row}}
+        for row in _recent(FLEET_KEY, minutes)
+    ]
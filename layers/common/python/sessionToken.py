@@ -0,0 +1,172 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+import uuid
+
+import boto3
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TOKEN_TTL_SECONDS = 12 * 60 * 60
+DENYLIST_REFRESH_SECONDS = 60
+# Header and body fields that carry a session token and must never be logged
+CREDENTIAL_FIELDS = ('authorization', 'token')
+REDACTED = '[redacted]'
+
+dynamodb = boto3.client('dynamodb')
+
+# Revoked token ids, refreshed from the deny-list table at most once per
+# DENYLIST_REFRESH_SECONDS and shared across warm invocations.
+_denylist = {'tokenIds': frozenset(), 'loadedAt': 0.0}
+
+
+class TokenError(ValueError):
+    """Raised when a session token is malformed, forged, expired or revoked"""
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _secret() -> bytes:
+    secret = os.environ.get('SESSION_TOKEN_SECRET')
+    if not secret:
+        raise ValueError('SESSION_TOKEN_SECRET environment variable is not set')
+    return secret.encode()
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(_secret(), payload.encode('ascii'), hashlib.sha256).digest())
+
+
+def issue_token(user_id: str, is_active: bool, quota: dict, ttl: int = TOKEN_TTL_SECONDS) -> str:
+    """Issue a compact signed token: base64url(claims).base64url(hmac-sha256)"""
+    now = int(time.time())
+    claims = {
+        'sub': user_id,
+        'act': bool(is_active),
+        'iat': now,
+        'exp': now + ttl,
+        'jti': uuid.uuid4().hex,
+        'q': quota,
+    }
+    payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_token(token: str) -> dict:
+    """Verify signature, expiry, active flag and revocation; return the claims"""
+    if not isinstance(token, str) or not token.isascii() or token.count('.') != 1:
+        raise TokenError('Malformed session token')
+
+    payload, signature = token.split('.')
+    if not hmac.compare_digest(signature, _sign(payload)):
+        raise TokenError('Invalid session token signature')
+
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        raise TokenError('Malformed session token')
+
+    if claims.get('exp', 0) <= time.time():
+        raise TokenError('Session token expired')
+    if not claims.get('act'):
+        raise TokenError('User not found or inactive')
+    if is_revoked(claims):
+        raise TokenError('Session token revoked')
+    return claims
+
+
+def get_token_from_event(event, body):
+    """Read the bearer token from the Authorization header or the request body"""
+    headers = event.get('headers') or {}
+    authorization = headers.get('authorization') or headers.get('Authorization') or ''
+    if authorization.lower().startswith('bearer '):
+        return authorization[7:].strip()
+    return body.get('token')
+
+
+def redact_event(event):
+    """Copy of a Lambda event that is safe to log, with session tokens masked"""
+    safe = dict(event)
+    headers = event.get('headers')
+    if isinstance(headers, dict):
+        safe['headers'] = {
+            name: REDACTED if name.lower() in CREDENTIAL_FIELDS else value
+            for name, value in headers.items()
+        }
+    body = event.get('body')
+    if body:
+        try:
+            parsed = None if event.get('isBase64Encoded') else json.loads(body)
+        except ValueError:
+            parsed = None
+        if isinstance(parsed, dict):
+            safe['body'] = json.dumps({
+                name: REDACTED if name.lower() in CREDENTIAL_FIELDS else value
+                for name, value in parsed.items()
+            })
+        else:
+            # Not a JSON object we can inspect; it could still hold a token
+            safe['body'] = REDACTED
+    return safe
+
+
+def _load_denylist():
+    table = os.environ.get('SESSION_DENYLIST_TABLE')
+    if not table:
+        return frozenset()
+
+    now = int(time.time())
+    token_ids = set()
+    scan_params = {
+        'TableName': table,
+        'ProjectionExpression': 'tokenId',
+        'FilterExpression': 'expiresAt > :now',
+        'ExpressionAttributeValues': {':now': {'N': str(now)}},
+    }
+    while True:
+        response = dynamodb.scan(**scan_params)
+        token_ids.update(item['tokenId']['S'] for item in response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return frozenset(token_ids)
+
+
+def is_revoked(claims: dict) -> bool:
+    now = time.monotonic()
+    if now - _denylist['loadedAt'] >= DENYLIST_REFRESH_SECONDS:
+        try:
+            _denylist['tokenIds'] = _load_denylist()
+            _denylist['loadedAt'] = now
+        except Exception as err:
+            # Keep serving from the last known deny-list rather than failing auth
+            logger.error('Error refreshing session deny-list: %s', err)
+    return claims.get('jti') in _denylist['tokenIds']
+
+
+def revoke_token(claims: dict):
+    """Add a token to the deny-list until it would have expired anyway"""
+    table = os.environ.get('SESSION_DENYLIST_TABLE')
+    if not table:
+        raise ValueError('SESSION_DENYLIST_TABLE environment variable is not set')
+
+    dynamodb.put_item(
+        TableName=table,
+        Item={
+            'tokenId': {'S': claims['jti']},
+            'userId': {'S': claims['sub']},
+            'expiresAt': {'N': str(int(claims['exp']))},
+        }
+    )
+    _denylist['tokenIds'] = _denylist['tokenIds'] | {claims['jti']}